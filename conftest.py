@@ -0,0 +1,2 @@
+# Lets a bare `pytest` import healthandstatus from this checkout: pytest puts
+# the directory holding the root conftest.py on sys.path.
@@ -0,0 +1,254 @@
+''' asyncio counterparts of CustomMongodbDriver and CustomMongodbFileProcessor.
+
+pymongo calls run on a thread pool sized by the driver's concurrency, so
+many inserts can be in flight without blocking the event loop:
+
+    db = AsyncCustomMongodbDriver(concurrency=16, username="admin", password="admin")
+    db.setDatabase("HealthAndStatus")
+    pipeline = AsyncIngestPipeline(db, parse="process", inserts=16)
+    pipeline.setIgnoreFirstHeader(True)
+    results = await pipeline.run(src="/tmp/files", traits=[".dat"])
+'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import asyncio
+import functools
+import itertools
+import os
+
+from .ingest import IngestSettings
+from .manifest import scanTree
+from .mongodb import CustomMongodbDriver
+from .parsing import parseFilename
+
+
+class AsyncCursor(object):
+    ''' Async iterator over a pymongo cursor, fetching batchSize documents per executor call '''
+
+    def __init__(self, driver, cursor, batchSize=1000):
+        self.__driver = driver
+        # One iterator for the life of the cursor, whatever iter() returns
+        self.__cursor = iter(cursor)
+        self.__batchSize = batchSize
+        self.__buffer = []
+        self.__exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.__buffer:
+            if self.__exhausted:
+                raise StopAsyncIteration
+            self.__buffer = await self.__driver.run(lambda: list(itertools.islice(self.__cursor, self.__batchSize)))
+            self.__buffer.reverse()
+            if len(self.__buffer) < self.__batchSize:
+                self.__exhausted = True
+            if not self.__buffer:
+                raise StopAsyncIteration
+        return self.__buffer.pop()
+
+    async def toList(self):
+        return [doc async for doc in self]
+
+
+class AsyncCustomMongodbDriver(object):
+    ''' CRUD operations for asyncio code. Wraps a CustomMongodbDriver and runs
+    its calls on a thread pool; at most concurrency calls are in flight. '''
+
+    def __init__(self, host="127.0.0.1", port=27017, username=None, password=None, client=None,
+                 concurrency=8, driver=None):
+        self.sync = driver or CustomMongodbDriver(host=host, port=port, username=username,
+                                                  password=password, client=client)
+        self.concurrency = concurrency
+        self.__executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="aio-driver")
+        self.__semaphore = None
+
+    def setDatabase(self, database):
+        self.sync.setDatabase(database)
+
+    async def run(self, func, *args, **kwargs):
+        ''' Run a blocking call on the driver's pool '''
+        if self.__semaphore is None:
+            # Created lazily so it binds to the running loop
+            self.__semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.__semaphore:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.__executor, functools.partial(func, *args, **kwargs))
+
+    async def create(self, collection=None, data=None):
+        ''' Insert document(s) into a collection '''
+        return await self.run(self.sync.create, collection=collection, data=data)
+
+    async def bulkCreate(self, collection=None, data=None):
+        return await self.run(self.sync.bulkCreate, collection=collection, data=data)
+
+    async def read(self, collection=None, data=None, projection=None, sort=None, maxTimeMS=None):
+        ''' Query collection in database '''
+        return await self.run(self.sync.read, collection=collection, data=data, projection=projection,
+                              sort=sort, maxTimeMS=maxTimeMS)
+
+    def iterRead(self, collection=None, data=None, projection=None, sort=None, batchSize=1000, maxTimeMS=None, limit=0,
+                 allFields=False):
+        ''' Async cursor: async for doc in db.iterRead("collection", {...}) '''
+        cursor = self.sync.iterRead(collection=collection, data=data, projection=projection, sort=sort,
+                                    batchSize=batchSize, maxTimeMS=maxTimeMS, limit=limit, allFields=allFields)
+        return AsyncCursor(self, cursor, batchSize)
+
+    async def readPage(self, collection=None, data=None, pageSize=1000, after=None, key="date", projection=None, maxTimeMS=None):
+        return await self.run(self.sync.readPage, collection=collection, data=data, pageSize=pageSize,
+                              after=after, key=key, projection=projection, maxTimeMS=maxTimeMS)
+
+    async def update(self, collection=None, data=None, changes=None, upsert=False):
+        ''' Update data in a collection '''
+        return await self.run(self.sync.update, collection=collection, data=data, changes=changes, upsert=upsert)
+
+    async def delete(self, collection=None, query=None):
+        ''' Delete data from a collection '''
+        return await self.run(self.sync.delete, collection=collection, query=query)
+
+    async def createIndex(self, collection=None, index=None, unique=True):
+        return await self.run(self.sync.createIndex, collection=collection, index=index, unique=unique)
+
+    async def ensureIndex(self, collection=None, index=None, unique=True):
+        return await self.run(self.sync.ensureIndex, collection=collection, index=index, unique=unique)
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+
+
+class AsyncIngestPipeline(IngestSettings):
+    ''' asyncio ingestion. Files are read on an I/O pool, parsed on a thread
+    or process pool and inserted by concurrent writer tasks. Semaphores and a
+    bounded queue keep every stage from running ahead of the next. '''
+
+    def __init__(self, driver, parse="thread", workers=None, files=4, inserts=8, chunkSize=10000, queueDepth=16):
+        if parse not in ("thread", "process"):
+            raise Exception("Parse engine must be 'thread' or 'process'")
+        IngestSettings.__init__(self)
+        self.__db = driver
+        self.parse = parse
+        self.workers = workers or os.cpu_count() or 1
+        self.files = files
+        self.inserts = inserts
+        self.chunkSize = chunkSize
+        self.queueDepth = queueDepth
+
+        self.__results = {"files": 0, "total_rows": 0, "inserted": 0, "duplicates": 0, "failed": 0}
+
+    def getResults(self):
+        return dict(self.__results)
+
+    async def run(self, src=None, splitchar="_", sep=",", traits=[]):
+        ''' Ingest every new or changed file under src and return the totals '''
+        loop = asyncio.get_running_loop()
+        self.__io = ThreadPoolExecutor(max_workers=self.files, thread_name_prefix="aio-read")
+        if self.parse == "process":
+            self.__parsePool = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.__parsePool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="aio-parse")
+
+        try:
+            await self.__db.ensureIndex(collection="ingestedFiles", index=[("filename", 1)], unique=False)
+            lookup = None if self._overwrite else self.__lookup
+            # Walked lazily, a batch of entries at a time, so memory stays flat however big the tree
+            entries = scanTree(src, traits, lookup=lookup)
+            scanLock = asyncio.Lock()
+
+            async def nextEntry():
+                # The scan is a generator, so only one thread may advance it at a time
+                async with scanLock:
+                    return await loop.run_in_executor(self.__io, next, entries, None)
+
+            writeQueue = asyncio.Queue(maxsize=self.queueDepth)
+            writers = [asyncio.create_task(self.__writer(writeQueue)) for i in range(self.inserts)]
+
+            try:
+                readers = [asyncio.create_task(self.__readFiles(nextEntry, writeQueue, splitchar, sep))
+                           for i in range(self.files)]
+                await asyncio.gather(*readers)
+            finally:
+                await loop.run_in_executor(self.__io, entries.close)
+
+            await writeQueue.join()
+            for task in writers:
+                task.cancel()
+            await asyncio.gather(*writers, return_exceptions=True)
+        finally:
+            self.__io.shutdown(wait=True)
+            self.__parsePool.shutdown(wait=True)
+
+        return self.getResults()
+
+    def __lookup(self, filenames):
+        known = self.__db.sync.iterRead(collection="ingestedFiles", data={"filename": {"$in": filenames}},
+                                        batchSize=len(filenames))
+        return {x["filename"]: x for x in known}
+
+    async def __readFiles(self, nextEntry, writeQueue, splitchar, sep):
+        # Each task takes the next file until none are left, so at most
+        # self.files files are open at once
+        while True:
+            entry = await nextEntry()
+            if entry is None:
+                break
+            try:
+                await self.__ingest(entry, writeQueue, splitchar, sep)
+            except Exception as e:
+                print(str(e))
+
+    async def __ingest(self, entry, writeQueue, splitchar, sep):
+        loop = asyncio.get_running_loop()
+        filename = entry["filename"]
+        info = parseFilename(filename, splitchar)
+        collection = info["collection"]
+
+        if not self._idAlgorithm:
+            await self.__db.ensureIndex(collection=collection, index=[("hash", 'text')])
+
+        chunks, parser = self._openChunks(filename, sep, self.chunkSize)
+        done = []
+        schema = None
+        rows = 0
+
+        try:
+            while True:
+                chunk = await loop.run_in_executor(self.__io, next, chunks, None)
+                if chunk is None:
+                    break
+                headers, lines = chunk
+                if schema is None:
+                    schema = self._resolveSchema(collection, headers, lines, sep)
+                data = await loop.run_in_executor(self.__parsePool, parser, info, headers, lines, sep,
+                                                  self._idAlgorithm, schema)
+                future = loop.create_future()
+                done.append(future)
+                # Blocks while the writers are queueDepth chunks behind
+                await writeQueue.put((collection, data, future))
+                rows += len(data)
+        finally:
+            await loop.run_in_executor(self.__io, chunks.close)
+
+        self.__results["files"] += 1
+        self.__results["total_rows"] += rows
+
+        # Mark only once every chunk has been written without failures
+        if all(await asyncio.gather(*done)):
+            await self.__db.update(collection="ingestedFiles", data={"filename": filename}, changes=entry, upsert=True)
+
+    async def __writer(self, writeQueue):
+        while True:
+            collection, data, future = await writeQueue.get()
+            try:
+                result = await self.__db.bulkCreate(collection=collection, data=data)
+                if result["error"] is not None:
+                    print(str(result["error"]))
+                self.__results["inserted"] += result["inserted"]
+                self.__results["duplicates"] += result["duplicates"]
+                self.__results["failed"] += result["failed"]
+                future.set_result(result["failed"] == 0)
+            except Exception as e:
+                print(str(e))
+                self.__results["failed"] += len(data)
+                future.set_result(False)
+            finally:
+                writeQueue.task_done()
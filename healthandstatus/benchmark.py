@@ -0,0 +1,496 @@
+''' Ingestion benchmark.
+
+Generates a synthetic tree of owner_collection_system_DTG.dat files and runs
+the full CustomMongodbFileProcessor pipeline against it, reporting rows/sec,
+peak RSS and per-stage latency percentiles.
+
+    python -m healthandstatus.benchmark --files 200 --rows 5000 --engine process
+
+Backends: "fake" (in-process, no server), "mongomock" (if installed) or
+"mongod" (spawns throwaway local mongods, which must be on PATH). --nodes N
+routes across N independent backends.
+'''
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from pymongo import MongoClient, errors
+import argparse
+import bson
+import copy
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+from .mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+from .parsing import ProcessParseBackend
+from .routing import CollectionRoutingPolicy, HashRangeRoutingPolicy
+from .splitter import generateTree
+
+
+# In-process stand-in for pymongo, covering what the driver and processor use
+
+def _matches(doc, query):
+    for key, cond in query.items():
+        if key == "$and":
+            if not all(_matches(doc, q) for q in cond):
+                return False
+            continue
+        if key == "$or":
+            if not any(_matches(doc, q) for q in cond):
+                return False
+            continue
+        value = doc.get(key)
+        if isinstance(cond, dict) and cond and all(k.startswith("$") for k in cond):
+            for op, arg in cond.items():
+                if op == "$in" and value not in arg:
+                    return False
+                if op == "$gt" and not (value is not None and value > arg):
+                    return False
+                if op == "$gte" and not (value is not None and value >= arg):
+                    return False
+                if op == "$lt" and not (value is not None and value < arg):
+                    return False
+                if op == "$lte" and not (value is not None and value <= arg):
+                    return False
+        elif value != cond:
+            return False
+    return True
+
+
+def _project(doc, projection):
+    if not projection:
+        return dict(doc)
+    # Any true value makes it an inclusion projection, as on the server;
+    # {"_id": 1} alone returns just the _id
+    if any(projection.values()):
+        out = {k: doc[k] for k, v in projection.items() if v and k != "_id" and k in doc}
+        if projection.get("_id", True) and "_id" in doc:
+            out["_id"] = doc["_id"]
+        return out
+    return {k: v for k, v in doc.items() if projection.get(k, True)}
+
+
+def _applyUpdate(doc, changes):
+    for op, fields in changes.items():
+        for path, value in fields.items():
+            parts = path.split(".")
+            target = doc
+            for part in parts[:-1]:
+                target = target.setdefault(part, {})
+            name = parts[-1]
+            if op == "$push":
+                target.setdefault(name, []).append(value)
+            elif op == "$pull":
+                target[name] = [item for item in target.get(name, [])
+                                if not (isinstance(value, dict) and _matches(item, value)) and item != value]
+            elif op == "$set" or name not in target:
+                target[name] = value
+            elif op == "$inc":
+                target[name] += value
+            elif op == "$min":
+                target[name] = min(target[name], value)
+            elif op == "$max":
+                target[name] = max(target[name], value)
+
+
+class _FakeResult(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeCursor(object):
+    ''' One-shot iterator like pymongo's Cursor: iterating twice continues
+    where the first pass stopped rather than starting over '''
+
+    def __init__(self, docs, projection, limit):
+        self.__docs = docs
+        self.__projection = projection
+        self.__limit = limit
+        self.__iterator = None
+
+    def sort(self, keys):
+        for key, direction in reversed(keys):
+            self.__docs.sort(key=lambda d: (d.get(key) is not None, d.get(key)), reverse=direction < 0)
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    def max_time_ms(self, ms):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__iterator is None:
+            docs = self.__docs[:self.__limit] if self.__limit else self.__docs
+            self.__iterator = iter(docs)
+        return _project(next(self.__iterator), self.__projection)
+
+
+class FakeCollection(object):
+    ''' Dict-backed collection with _id and unique-index enforcement '''
+
+    def __init__(self, name, latency=0.0):
+        self.name = name
+        self.__docs = {}
+        self.__unique = {}
+        self.__indexes = {"_id_": [("_id", 1)]}
+        self.__lock = threading.Lock()
+        self.latency = latency
+
+    def with_options(self, **kwargs):
+        return self
+
+    def __wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def list_indexes(self):
+        return [{"name": name, "key": dict(keys)} for name, keys in self.__indexes.items()]
+
+    def create_index(self, keys, unique=False, name=None):
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        name = name or "_".join("{0}_{1}".format(k, d) for k, d in keys)
+        with self.__lock:
+            self.__indexes[name] = keys
+            if unique:
+                fields = tuple(k for k, d in keys)
+                self.__unique[fields] = set(tuple(doc.get(f) for f in fields) for doc in self.__docs.values())
+        return name
+
+    def bulk_write(self, requests, ordered=True, bypass_document_validation=False):
+        self.__wait()
+        inserted = 0
+        writeErrors = []
+        with self.__lock:
+            for index, request in enumerate(requests):
+                doc = request._doc
+                if isinstance(doc, RawBSONDocument):
+                    doc = bson.decode(doc.raw)
+                if "_id" not in doc:
+                    doc["_id"] = ObjectId()
+                keys = [(fields, tuple(doc.get(f) for f in fields)) for fields in self.__unique]
+                if doc["_id"] in self.__docs or any(key in self.__unique[fields] for fields, key in keys):
+                    writeErrors.append({"index": index, "code": 11000, "errmsg": "E11000 duplicate key error"})
+                    if ordered:
+                        break
+                    continue
+                self.__docs[doc["_id"]] = copy.copy(doc)
+                for fields, key in keys:
+                    self.__unique[fields].add(key)
+                inserted += 1
+        if writeErrors:
+            raise errors.BulkWriteError({"writeErrors": writeErrors, "nInserted": inserted})
+        return _FakeResult(inserted_count=inserted)
+
+    def find(self, query=None, projection=None, limit=0):
+        self.__wait()
+        with self.__lock:
+            docs = [d for d in self.__docs.values() if _matches(d, query or {})]
+        return FakeCursor(docs, projection, limit)
+
+    def update_many(self, query, changes, upsert=False):
+        self.__wait()
+        with self.__lock:
+            matched = [d for d in self.__docs.values() if _matches(d, query)]
+            for doc in matched:
+                doc.update(changes.get("$set", {}))
+            if not matched and upsert:
+                doc = dict(query)
+                doc.update(changes.get("$set", {}))
+                doc["_id"] = ObjectId()
+                self.__docs[doc["_id"]] = doc
+        return _FakeResult(matched_count=len(matched), raw_result={"n": len(matched)})
+
+    def update_one(self, query, changes, upsert=False):
+        self.__wait()
+        with self.__lock:
+            matched = next((d for d in self.__docs.values() if _matches(d, query)), None)
+            if matched is not None:
+                _applyUpdate(matched, changes)
+            elif upsert:
+                doc = dict(query)
+                _applyUpdate(doc, changes)
+                doc.setdefault("_id", ObjectId())
+                self.__docs[doc["_id"]] = doc
+        return _FakeResult(matched_count=1 if matched is not None else 0)
+
+    def delete_many(self, query):
+        self.__wait()
+        with self.__lock:
+            doomed = [k for k, d in self.__docs.items() if _matches(d, query)]
+            for key in doomed:
+                del self.__docs[key]
+        return _FakeResult(deleted_count=len(doomed), raw_result={"n": len(doomed)})
+
+    def count_documents(self, query):
+        with self.__lock:
+            return sum(1 for d in self.__docs.values() if _matches(d, query))
+
+
+class FakeDatabase(object):
+
+    def __init__(self, latency=0.0):
+        self.__collections = {}
+        self.__latency = latency
+        self.__lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self.__lock:
+            if name not in self.__collections:
+                self.__collections[name] = FakeCollection(name, self.__latency)
+            return self.__collections[name]
+
+
+class FakeClient(object):
+    ''' Enough of MongoClient to run the ingestion pipeline in-process.
+    latency adds a fixed delay to every server call to mimic a network hop. '''
+
+    def __init__(self, latency=0.0):
+        self.__databases = {}
+        self.__latency = latency
+
+    def __getitem__(self, name):
+        if name not in self.__databases:
+            self.__databases[name] = FakeDatabase(self.__latency)
+        return self.__databases[name]
+
+    def close(self):
+        pass
+
+
+class LocalMongod(object):
+    ''' Throwaway mongod on a free port with its data in a temporary directory '''
+
+    def __init__(self, binary="mongod"):
+        self.binary = binary
+        self.process = None
+        self.dbpath = None
+        self.port = None
+
+    def __enter__(self):
+        self.dbpath = tempfile.mkdtemp(prefix="hs-bench-mongod-")
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.process = subprocess.Popen([self.binary, "--dbpath", self.dbpath, "--port", str(self.port),
+                                         "--bind_ip", "127.0.0.1", "--quiet"],
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        client = MongoClient("127.0.0.1", self.port, serverSelectionTimeoutMS=500)
+        deadline = time.time() + 30
+        while True:
+            try:
+                client.admin.command("ping")
+                break
+            except errors.ConnectionFailure:
+                if time.time() > deadline or self.process.poll() is not None:
+                    self.__exit__(None, None, None)
+                    raise Exception("mongod did not start")
+                time.sleep(0.2)
+        client.close()
+        return self
+
+    def __exit__(self, *exc):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+            self.process = None
+        if self.dbpath:
+            shutil.rmtree(self.dbpath, ignore_errors=True)
+
+
+class StageRecorder(object):
+    ''' Stage observer collecting latency samples per pipeline stage '''
+
+    def __init__(self):
+        self.samples = {}
+        self.rows = {}
+        self.__lock = threading.Lock()
+
+    def __call__(self, stage, seconds, rows=0):
+        with self.__lock:
+            self.samples.setdefault(stage, []).append(seconds)
+            self.rows[stage] = self.rows.get(stage, 0) + rows
+
+    def summary(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            samples = sorted(samples)
+            report[stage] = {
+                "count": len(samples),
+                "total": sum(samples),
+                "p50": percentile(samples, 50),
+                "p90": percentile(samples, 90),
+                "p99": percentile(samples, 99),
+                "max": samples[-1],
+            }
+        return report
+
+
+def percentile(samples, pct):
+    ''' Nearest-rank percentile of an already sorted list '''
+    if not samples:
+        return 0.0
+    rank = max(0, min(len(samples) - 1, int(round(pct / 100.0 * len(samples))) - 1))
+    return samples[rank]
+
+
+def peakRss():
+    ''' Peak resident set size in MB for this process and its largest child '''
+    scale = 1024.0 if os.uname().sysname != "Darwin" else 1024.0 * 1024.0
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return {"self": own, "children": children}
+
+
+def createClient(backend, latency=0.0):
+    if backend == "fake":
+        return FakeClient(latency)
+    if backend == "mongomock":
+        try:
+            import mongomock
+        except ImportError:
+            raise Exception("mongomock is not installed")
+        return mongomock.MongoClient()
+    raise Exception("Unknown backend: {0}".format(backend))
+
+
+def createRouting(name):
+    if name == "hash":
+        return HashRangeRoutingPolicy()
+    if name == "collection":
+        return CollectionRoutingPolicy()
+    raise Exception("Unknown routing policy: {0}".format(name))
+
+
+def runBenchmark(files=100, rows=1000, columns=5, backend="fake", engine="thread", workers=None,
+                 chunkSize=None, queueDepth=None, reader="text", digestId=False, inferTypes=False,
+                 latency=0.0, nodes=1, routing="hash", rollups=None, root=None, keep=False):
+    ''' Generate a corpus, ingest it and return a report dict '''
+    cleanup = root is None
+    root = root or tempfile.mkdtemp(prefix="hs-bench-")
+    mongods = []
+
+    try:
+        started = time.perf_counter()
+        generated = generateTree(root, files=files, rows=rows, columns=columns)
+        generateSeconds = time.perf_counter() - started
+
+        if backend == "mongod":
+            for i in range(nodes):
+                mongods.append(LocalMongod().__enter__())
+            targets = [("127.0.0.1", mongod.port) for mongod in mongods]
+        else:
+            targets = [createClient(backend, latency) for i in range(nodes)]
+        db = CustomMongodbDriver(nodes=targets, routing=createRouting(routing) if nodes > 1 else None)
+        db.setDatabase("HealthAndStatusBenchmark")
+        if backend == "mongomock":
+            # mongomock rejects bypass_document_validation
+            db.writer.bypassValidation = False
+
+        processor = CustomMongodbFileProcessor(driver=db)
+        processor.setIgnoreFirstHeader(True)
+        processor.setProgress(False)
+        if backend == "mongomock" and engine == "process":
+            # mongomock only accepts mutable documents, not RawBSONDocuments
+            processor.setParseBackend(ProcessParseBackend(workers, encode=False))
+        else:
+            processor.setParseBackend(engine, workers)
+        processor.setChunkSize(chunkSize)
+        processor.setQueueDepth(queueDepth)
+        processor.setReader(reader)
+        processor.setDigestId(digestId)
+        processor.setInferTypes(inferTypes)
+        if rollups:
+            processor.setRollups(True, rollups)
+        recorder = StageRecorder()
+        processor.setStageObserver(recorder)
+
+        started = time.perf_counter()
+        processor.start(src=root, splitchar="_", sep=",", traits=[".dat"])
+        seconds = time.perf_counter() - started
+
+        return {
+            "files": files,
+            "rows": generated,
+            "generate_seconds": generateSeconds,
+            "seconds": seconds,
+            "rows_per_sec": generated / seconds if seconds else 0.0,
+            "results": processor.getResults(),
+            "peak_rss_mb": peakRss(),
+            "stages": recorder.summary(),
+            "config": {"backend": backend, "engine": engine, "workers": workers, "chunk_size": chunkSize,
+                       "queue_depth": queueDepth, "reader": reader, "digest_id": digestId,
+                       "infer_types": inferTypes, "latency": latency,
+                       "nodes": nodes, "routing": routing, "rollups": rollups},
+        }
+    finally:
+        for mongod in mongods:
+            mongod.__exit__(None, None, None)
+        if cleanup and not keep:
+            shutil.rmtree(root, ignore_errors=True)
+
+
+def formatReport(report):
+    lines = [
+        "Rows:          {0} in {1} files".format(report["rows"], report["files"]),
+        "Ingest time:   {0:.2f}s".format(report["seconds"]),
+        "Rows/sec:      {0:.0f}".format(report["rows_per_sec"]),
+        "Inserted:      {0} ({1} duplicate, {2} failed)".format(report["results"]["inserted"],
+                                                                report["results"]["duplicates"],
+                                                                report["results"]["failed"]),
+        "Peak RSS:      {0:.1f} MB (largest child {1:.1f} MB)".format(report["peak_rss_mb"]["self"],
+                                                                      report["peak_rss_mb"]["children"]),
+        "",
+        "{0:<10} {1:>7} {2:>10} {3:>10} {4:>10} {5:>10}".format("stage", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"),
+    ]
+    for stage, s in sorted(report["stages"].items()):
+        lines.append("{0:<10} {1:>7} {2:>10.2f} {3:>10.2f} {4:>10.2f} {5:>10.2f}".format(
+            stage, s["count"], s["p50"] * 1000, s["p90"] * 1000, s["p99"] * 1000, s["max"] * 1000))
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark H&S .dat ingestion")
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--rows", type=int, default=1000, help="data rows per file")
+    parser.add_argument("--columns", type=int, default=5)
+    parser.add_argument("--backend", choices=["fake", "mongomock", "mongod"], default="fake")
+    parser.add_argument("--nodes", type=int, default=1, help="independent backends (mongod processes) to route across")
+    parser.add_argument("--routing", choices=["hash", "collection"], default="hash")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to each fake server call")
+    parser.add_argument("--engine", choices=["thread", "process"], default="thread")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--chunk-size", type=int, default=None)
+    parser.add_argument("--queue-depth", type=int, default=None)
+    parser.add_argument("--reader", choices=["text", "mmap"], default="text")
+    parser.add_argument("--digest-id", action="store_true")
+    parser.add_argument("--infer-types", action="store_true")
+    parser.add_argument("--rollups", choices=["minute", "hour", "day"], default=None,
+                        help="maintain rollups at this granularity while ingesting")
+    parser.add_argument("--root", default=None, help="generate the corpus here instead of a temp dir")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    report = runBenchmark(files=args.files, rows=args.rows, columns=args.columns, backend=args.backend,
+                          engine=args.engine, workers=args.workers, chunkSize=args.chunk_size,
+                          queueDepth=args.queue_depth, reader=args.reader, digestId=args.digest_id,
+                          inferTypes=args.infer_types, latency=args.latency, nodes=args.nodes,
+                          routing=args.routing, rollups=args.rollups, root=args.root,
+                          keep=args.root is not None)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(formatReport(report))
+
+
+if __name__ == "__main__":
+    main()
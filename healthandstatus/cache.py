@@ -0,0 +1,111 @@
+from collections import OrderedDict
+import bson
+import threading
+import time
+
+
+def normalizeQuery(value, top=True):
+    ''' Hashable form of a query, projection or sort. Top-level and operator
+    keys are sorted; embedded documents keep their order because MongoDB
+    matches those field by field in order. '''
+    if isinstance(value, dict):
+        items = value.items()
+        if top or all(str(k).startswith("$") for k in value):
+            items = sorted(items, key=lambda item: str(item[0]))
+        return ("d",) + tuple((k, normalizeQuery(v, False)) for k, v in items)
+    if isinstance(value, (list, tuple)):
+        return ("l",) + tuple(normalizeQuery(v, False) for v in value)
+    return (type(value).__name__, repr(value))
+
+
+def resultSize(documents):
+    return sum(len(bson.encode(doc)) for doc in documents)
+
+
+class QueryCache(object):
+    ''' LRU + TTL cache of read() results with a byte budget.
+    Entries are grouped by collection so a write can drop them all at once.
+    A generation counter per collection stops a read that raced a write from
+    storing a stale result. '''
+
+    def __init__(self, maxEntries=1024, ttl=60.0, maxBytes=64 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+        self.__entries = OrderedDict()   # key -> (expires, size, documents)
+        self.__byCollection = {}
+        self.__generations = {}
+        self.__epoch = 0
+        self.__lock = threading.Lock()
+
+    def key(self, collection, query, projection, sort):
+        return (collection, normalizeQuery(query or {}), normalizeQuery(projection or {}), normalizeQuery(sort or []))
+
+    def generation(self, collection):
+        with self.__lock:
+            return (self.__epoch, self.__generations.get(collection, 0))
+
+    def get(self, key):
+        ''' Cached documents for key, or None '''
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[0] < time.time():
+                self.__remove(key)
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.stats["hits"] += 1
+            # New list so callers can't reorder the cached one
+            return list(entry[2])
+
+    def put(self, key, documents, generation):
+        size = resultSize(documents)
+        if size > self.maxBytes:
+            return
+        collection = key[0]
+        with self.__lock:
+            if (self.__epoch, self.__generations.get(collection, 0)) != generation:
+                # A write landed while this result was being read
+                return
+            if key in self.__entries:
+                self.__remove(key)
+            self.__entries[key] = (time.time() + self.ttl, size, list(documents))
+            self.__byCollection.setdefault(collection, set()).add(key)
+            self.bytes += size
+            while self.__entries and (len(self.__entries) > self.maxEntries or self.bytes > self.maxBytes):
+                oldest = next(iter(self.__entries))
+                self.__remove(oldest)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, collection=None):
+        ''' Drop every entry for collection (or everything) '''
+        with self.__lock:
+            collections = [collection] if collection is not None else list(self.__byCollection)
+            for name in collections:
+                self.__generations[name] = self.__generations.get(name, 0) + 1
+                for key in list(self.__byCollection.get(name, ())):
+                    self.__remove(key)
+                    self.stats["invalidations"] += 1
+            if collection is None:
+                # Also covers collections with reads in flight but nothing cached yet
+                self.__epoch += 1
+
+    def __remove(self, key):
+        expires, size, documents = self.__entries.pop(key)
+        self.bytes -= size
+        keys = self.__byCollection.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.__byCollection[key[0]]
+
+    def snapshot(self):
+        with self.__lock:
+            return dict(self.stats, entries=len(self.__entries), bytes=self.bytes)
@@ -0,0 +1,76 @@
+from .parsing import HASH_ALGORITHMS, createHasher, parseLines, parseSpan, readBlocks, readChunks, readSpans, spanLines
+from .schema import SchemaRegistry
+
+
+class IngestSettings(object):
+    ''' Settings and per-file steps shared by CustomMongodbFileProcessor and
+    AsyncIngestPipeline, so the two read, type and identify rows the same way '''
+
+    def __init__(self):
+        self._ignoreFirstHeader = False
+        self._overwrite = False
+        self._reader = "text"
+        self._idAlgorithm = None
+        self._schemas = SchemaRegistry()
+
+    def setIgnoreFirstHeader(self, value):
+        if isinstance(value, bool):
+            self._ignoreFirstHeader = value
+        else:
+            raise Exception("Value must be True or False")
+
+    def setOverwrite(self, value):
+        if isinstance(value, bool):
+            self._overwrite = value
+        else:
+            raise Exception("Overwrite value must be True or False")
+
+    def setDigestId(self, value, algorithm="blake2b"):
+        ''' Store a binary row digest as _id instead of an md5 "hash" column.
+        algorithm is one of "blake2b", "xxhash" (if installed) or "md5". '''
+        if not isinstance(value, bool):
+            raise Exception("Value must be True or False")
+        if algorithm not in HASH_ALGORITHMS:
+            raise Exception("Algorithm must be one of {0}".format(", ".join(HASH_ALGORITHMS)))
+        if value:
+            # Fail now rather than in every worker if xxhash is missing
+            createHasher(algorithm)
+        self._idAlgorithm = algorithm if value else None
+
+    def setInferTypes(self, value):
+        ''' Infer int/float/bool/datetime columns from the first rows of each header layout '''
+        if isinstance(value, bool):
+            self._schemas.infer = value
+        else:
+            raise Exception("Value must be True or False")
+
+    def setSchema(self, collection, types):
+        ''' Declare column types for a collection, e.g. {"cpu": "float", "ts": "datetime:%Y-%m-%d %H:%M:%S"} '''
+        if not isinstance(types, dict):
+            raise Exception("Types must be a dict of column name to type")
+        self._schemas.setSchema(collection, types)
+
+    def setReader(self, value):
+        ''' "text" reads files line by line; "mmap" decodes and splits a
+        memory-mapped file a large window at a time '''
+        if value in ("text", "mmap"):
+            self._reader = value
+        else:
+            raise Exception("Reader must be 'text' or 'mmap'")
+
+    def _openChunks(self, filename, sep, chunkSize, spans=False):
+        ''' (chunks, parser): a generator of (headers, lines) for filename and
+        the parse function that takes them. With spans, lines is a byte range
+        the parser reads itself, whichever reader is set. '''
+        if spans:
+            return readSpans(filename, sep, self._ignoreFirstHeader, chunkSize), parseSpan
+        read = readBlocks if self._reader == "mmap" else readChunks
+        return read(filename, sep, self._ignoreFirstHeader, chunkSize), parseLines
+
+    def _resolveSchema(self, collection, headers, lines, sep):
+        ''' Column converters for a file, from the first chunk it yields '''
+        if isinstance(lines, tuple):
+            # A span; a sample is read only for a layout not seen before
+            span = lines
+            lines = lambda: spanLines(span, 100)
+        return self._schemas.resolve(collection, headers, lines, sep) or ()
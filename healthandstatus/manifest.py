@@ -0,0 +1,105 @@
+import hashlib
+import os
+
+
+def fileDigest(filename, blocksize=1 << 20):
+    ''' md5 of a file's contents, read in blocks '''
+    digest = hashlib.md5()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def manifestEntry(filename, stat, digest=False):
+    ''' Build the ingestedFiles document describing a file as it is now '''
+    entry = {
+        "filename": filename,
+        "directory": os.path.dirname(filename),
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+    }
+    if digest:
+        entry["digest"] = fileDigest(filename)
+    return entry
+
+
+def isChanged(entry, known):
+    ''' Compare a fresh entry against the recorded one. Entries written before
+    size/mtime were tracked only have a filename and count as unchanged. '''
+    if "size" not in known:
+        return False
+    return entry["size"] != known["size"] or entry["mtime"] != known.get("mtime")
+
+
+def scanTree(src, traits, lookup=None, digest=False, refresh=None, batchSize=1000, cache=None, onDirectory=None):
+    ''' Yield manifest entries for files under src that are new or changed.
+
+    lookup(filenames) returns {filename: recorded entry} and is called once per
+    batch of candidates in a directory, so memory stays flat however many files
+    have been ingested. Files whose stat changed but whose digest did not are
+    passed to refresh(entry) instead of being yielded.
+
+    cache, if given, maps filename -> (size, mtime) for files already known to
+    be ingested. Matching files are skipped without a lookup and files the
+    lookup confirms as unchanged are added, so long-running callers only hit
+    the database for files they have not seen. onDirectory(path) is called for
+    each directory visited. '''
+    stack = [src]
+
+    while stack:
+        directory = stack.pop()
+        candidates = []
+
+        if onDirectory:
+            onDirectory(directory)
+
+        try:
+            with os.scandir(directory) as it:
+                for item in it:
+                    if item.is_dir(follow_symlinks=False):
+                        stack.append(item.path)
+                    elif item.is_file() and all(trait in item.path for trait in traits):
+                        try:
+                            stat = item.stat()
+                        except OSError as e:
+                            print(str(e))
+                            continue
+                        if cache is not None and cache.get(item.path) == (stat.st_size, stat.st_mtime):
+                            continue
+                        candidates.append((item.path, stat))
+        except OSError as e:
+            print(str(e))
+            continue
+
+        for i in range(0, len(candidates), batchSize):
+            batch = candidates[i:i + batchSize]
+            known = lookup([path for path, stat in batch]) if lookup else {}
+
+            for path, stat in batch:
+                try:
+                    previous = known.get(path)
+
+                    if previous is None:
+                        yield manifestEntry(path, stat, digest)
+                        continue
+
+                    entry = manifestEntry(path, stat)
+                    if not isChanged(entry, previous):
+                        if cache is not None:
+                            cache[path] = (stat.st_size, stat.st_mtime)
+                        continue
+
+                    if digest:
+                        entry["digest"] = fileDigest(path)
+                        if entry["digest"] == previous.get("digest"):
+                            # Touched but identical; just record the new stat
+                            if refresh:
+                                refresh(entry)
+                            if cache is not None:
+                                cache[path] = (stat.st_size, stat.st_mtime)
+                            continue
+
+                    yield entry
+                except OSError as e:
+                    print(str(e))
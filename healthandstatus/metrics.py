@@ -0,0 +1,205 @@
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+
+# Upper bounds in seconds, roughly log spaced from 1ms to 1 minute
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        cumulative = []
+        running = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            running += count
+            cumulative.append((bound, running))
+        return {"count": self.count, "sum": self.sum, "buckets": cumulative}
+
+
+class Metrics(object):
+    ''' Thread-safe counters, gauges and histograms with JSON and Prometheus export.
+    Each metric is a name plus optional labels, e.g. observe("stage_seconds", 0.2, stage="parse"). '''
+
+    def __init__(self, prefix="healthandstatus"):
+        self.prefix = prefix
+        self.started = time.time()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+        self.__lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        ''' Set a gauge. value may be a callable, read at export time. '''
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            self.__gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = self.__histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def reset(self):
+        with self.__lock:
+            self.__counters.clear()
+            self.__histograms.clear()
+            self.started = time.time()
+
+    def snapshot(self):
+        ''' Plain-data copy of every metric, with a per-second rate for each counter '''
+        with self.__lock:
+            counters = dict(self.__counters)
+            gauges = dict(self.__gauges)
+            histograms = {key: h.snapshot() for key, h in self.__histograms.items()}
+        elapsed = max(time.time() - self.started, 1e-9)
+
+        out = {"uptime_seconds": elapsed, "counters": [], "gauges": [], "histograms": []}
+        for (name, labels), value in sorted(counters.items()):
+            out["counters"].append({"name": name, "labels": dict(labels), "value": value,
+                                    "per_second": value / elapsed})
+        for (name, labels), value in sorted(gauges.items(), key=lambda item: item[0]):
+            if callable(value):
+                try:
+                    value = value()
+                except Exception:
+                    continue
+            out["gauges"].append({"name": name, "labels": dict(labels), "value": value})
+        for (name, labels), h in sorted(histograms.items()):
+            h = dict(h)
+            h["buckets"] = [[bound if bound != float("inf") else "+Inf", count] for bound, count in h["buckets"]]
+            out["histograms"].append(dict(h, name=name, labels=dict(labels)))
+        return out
+
+
+def _labels(labels, extra=None):
+    items = list(labels.items()) + (list(extra.items()) if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in items) + "}"
+
+
+def toJSON(*registries):
+    ''' Render one or more registries as a JSON document '''
+    return json.dumps({r.prefix: r.snapshot() for r in registries}, indent=2, default=str)
+
+
+def toPrometheus(*registries):
+    ''' Render one or more registries in the Prometheus text exposition format '''
+    lines = []
+    for registry in registries:
+        snap = registry.snapshot()
+        prefix = registry.prefix + "_"
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append("# TYPE {0} {1}".format(name, kind))
+
+        header(prefix + "uptime_seconds", "gauge")
+        lines.append("{0}uptime_seconds {1}".format(prefix, snap["uptime_seconds"]))
+        for c in snap["counters"]:
+            name = prefix + c["name"] + "_total"
+            header(name, "counter")
+            lines.append("{0}{1} {2}".format(name, _labels(c["labels"]), c["value"]))
+        for g in snap["gauges"]:
+            name = prefix + g["name"]
+            header(name, "gauge")
+            lines.append("{0}{1} {2}".format(name, _labels(g["labels"]), g["value"]))
+        for h in snap["histograms"]:
+            name = prefix + h["name"]
+            header(name, "histogram")
+            for bound, count in h["buckets"]:
+                lines.append("{0}_bucket{1} {2}".format(name, _labels(h["labels"], {"le": bound}), count))
+            lines.append("{0}_sum{1} {2}".format(name, _labels(h["labels"]), h["sum"]))
+            lines.append("{0}_count{1} {2}".format(name, _labels(h["labels"]), h["count"]))
+    return "\n".join(lines) + "\n"
+
+
+def writeAtomic(path, text):
+    ''' Replace path in one step so scrapers never see a half-written file '''
+    tmp = "{0}.tmp".format(path)
+    with open(tmp, 'w') as file:
+        file.write(text)
+    os.replace(tmp, path)
+
+
+# From 3.12 cProfile runs on sys.monitoring, which allows one active profiler
+# per process and sees every thread
+SHARED_PROFILER = sys.version_info >= (3, 12)
+
+
+class ThreadProfiler(object):
+    ''' One cProfile.Profile per pipeline thread, enabled only around each unit
+    of work. When shared (the default on 3.12 and later) a single profile covers
+    the whole process between start() and stop() instead. '''
+
+    def __init__(self, directory, shared=SHARED_PROFILER):
+        self.directory = directory
+        self.shared = shared
+        self.__profiles = {}
+        self.__lock = threading.Lock()
+
+    def start(self):
+        ''' Enable the process-wide profile when shared. Raises ValueError if
+        another profiler is already active. '''
+        if self.shared:
+            profile = cProfile.Profile()
+            profile.enable()
+            with self.__lock:
+                self.__profiles["process"] = profile
+
+    def stop(self):
+        if self.shared:
+            with self.__lock:
+                profile = self.__profiles.get("process")
+            if profile is not None:
+                profile.disable()
+
+    def profile(self):
+        ''' This thread's profile, or None when one profile covers the process '''
+        if self.shared:
+            return None
+        name = threading.current_thread().name
+        with self.__lock:
+            profile = self.__profiles.get(name)
+            if profile is None:
+                profile = self.__profiles[name] = cProfile.Profile()
+        return profile
+
+    def dump(self):
+        ''' Write <directory>/<thread>.prof for every thread that did work, or
+        <directory>/process.prof when shared '''
+        os.makedirs(self.directory, exist_ok=True)
+        with self.__lock:
+            profiles = dict(self.__profiles)
+        for name, profile in profiles.items():
+            profile.dump_stats(os.path.join(self.directory, "{0}.prof".format(name)))
@@ -1,87 +1,423 @@
 from pymongo import MongoClient, errors
+from pymongo.write_concern import WriteConcern
 from bson.objectid import ObjectId
-import os
+import contextlib
+import heapq
+import itertools
+import signal
 import types
-import datetime
-import hashlib
 import sys
 import time
 import progressbar
 import queue
 import threading
 
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from .cache import QueryCache
+from .manifest import fileDigest, scanTree
+from .ingest import IngestSettings
+from .metrics import Metrics, ThreadProfiler, toJSON, toPrometheus, writeAtomic
+from .parsing import createParseBackend, decodeDocuments, parseEncoded, parseFilename, parseTimed
+from .rollup import (GRANULARITIES, ROLLUP_COLLECTION, ROLLUP_KEY, ROLLUP_RANGES, RollupAccumulator,
+                     coveredRows, mergeRollups)
+from .routing import SingleNodePolicy, availableCompressors
+from .writer import BulkWriter
+
 class CustomMongodbDriver(object):
     """ CRUD operations """
     
     # Constructor
-    def __init__(self, host="127.0.0.1", port=27017, username=None, password=None):
+    def __init__(self, host="127.0.0.1", port=27017, username=None, password=None, client=None,
+                 nodes=None, routing=None, maxPoolSize=None, minPoolSize=None, maxIdleTimeMS=None,
+                 waitQueueTimeoutMS=None, connectTimeoutMS=None, socketTimeoutMS=None,
+                 serverSelectionTimeoutMS=None, compressors=None, zlibLevel=None):
         # Initializing the MongoClient. This helps to 
         # access the MongoDB databases and collections. 
-        self.client = MongoClient('{0}:{1}'.format(host, port), username=username, password=password)
+        # A ready-made client (e.g. an in-process fake for benchmarks) can be passed instead.
+        #
+        # nodes is a list of independent mongod targets ("host:port", (host, port)
+        # or client objects); routing decides which node(s) hold each collection
+        # (see healthandstatus.routing). compressors is a list such as
+        # ["zstd", "zlib"], or "auto" for whatever is installed.
+        options = {
+            "maxPoolSize": maxPoolSize,
+            "minPoolSize": minPoolSize,
+            "maxIdleTimeMS": maxIdleTimeMS,
+            "waitQueueTimeoutMS": waitQueueTimeoutMS,
+            "connectTimeoutMS": connectTimeoutMS,
+            "socketTimeoutMS": socketTimeoutMS,
+            "serverSelectionTimeoutMS": serverSelectionTimeoutMS,
+            "zlibCompressionLevel": zlibLevel,
+        }
+        options = {k: v for k, v in options.items() if v is not None}
+        if compressors == "auto":
+            compressors = availableCompressors()
+        if compressors:
+            options["compressors"] = compressors if isinstance(compressors, str) else ",".join(compressors)
+
+        if nodes is None:
+            nodes = [client if client is not None else (host, port)]
+
+        self.clients = []
+        for node in nodes:
+            if isinstance(node, tuple):
+                node = '{0}:{1}'.format(*node)
+            if isinstance(node, str):
+                node = MongoClient(node, username=username, password=password, **options)
+            self.clients.append(node)
+        self.client = self.clients[0]
+
+        self.routing = routing or SingleNodePolicy()
+        self.routing.bind(len(self.clients))
+
+        # (node, collection) -> names of indexes known to exist
+        self.__indexes = {}
+        self.__indexLock = threading.Lock()
+
+        self.metrics = Metrics(prefix="healthandstatus_driver")
+        self.writer = BulkWriter()
+        self.writer.metrics = self.metrics
+        self.cache = None
 
 
     def setDatabase(self, database):
-        self.database = self.client[database]
+        self.databases = [client[database] for client in self.clients]
+        self.database = self.databases[0]
+
+
+    def __targets(self, collection):
+        ''' (node, pymongo collection) for every node holding collection '''
+        return [(node, self.databases[node][collection]) for node in self.routing.nodesFor(collection)]
+
+
+    def setWriteConcern(self, w=1, j=None, wtimeout=None):
+        ''' Write concern used by create() and bulkCreate() '''
+        self.writer.writeConcern = WriteConcern(w=w, j=j, wtimeout=wtimeout)
+
+
+    def setBulkWriter(self, writer):
+        ''' Replace the writer, e.g. BulkWriter(retries=10, batcher=AdaptiveBatcher(maxDocs=100000)) '''
+        if not isinstance(writer, BulkWriter):
+            raise Exception("Writer must be a BulkWriter")
+        writer.writeConcern = writer.writeConcern or self.writer.writeConcern
+        writer.metrics = self.metrics
+        self.writer = writer
+
+
+    def enableCache(self, maxEntries=1024, ttl=60.0, maxBytes=64 * 1024 * 1024):
+        ''' Cache read() results in-process. Entries are evicted LRU-first past
+        maxEntries or maxBytes, expire after ttl seconds, and are dropped for a
+        collection whenever this driver writes to it. Writes from other
+        processes are only seen once entries expire. '''
+        self.cache = QueryCache(maxEntries=maxEntries, ttl=ttl, maxBytes=maxBytes)
+        for name in ("hits", "misses", "evictions", "expirations", "invalidations", "entries", "bytes"):
+            self.metrics.gauge("cache_" + name, lambda name=name: self.cache.snapshot()[name] if self.cache else 0)
+
+
+    def disableCache(self):
+        self.cache = None
+
+
+    def cacheStats(self):
+        ''' Hit, miss, eviction, expiration and invalidation counts plus current size '''
+        return self.cache.snapshot() if self.cache else {}
+
+
+    def __invalidate(self, collection):
+        if self.cache is not None:
+            self.cache.invalidate(collection)
+
+
+    @contextlib.contextmanager
+    def __writing(self, collection):
+        # Invalidate on both sides of a write: before, so nothing cached from
+        # the old data is served while it runs, and after, so a read that
+        # started mid-write can't cache what it saw
+        self.__invalidate(collection)
+        try:
+            yield
+        finally:
+            self.__invalidate(collection)
 
 
     def create(self, collection=None, data=None):
         ''' Insert document(s) into a collection '''
+        result = self.bulkCreate(collection=collection, data=data)
+        if isinstance(result["error"], errors.ConnectionFailure):
+            print("Connection lost")
+            sys.exit(1)
+        # duplicates are expected when re-ingesting, anything else is a failure
+        return result["failed"] == 0
+
+
+    def bulkCreate(self, collection=None, data=None, rejected=None):
+        ''' Insert a list of documents in adaptive batches, retrying transient errors.
+        Returns counts of inserted, duplicate and failed rows. If rejected is a
+        dict, the indexes into data of rows that were not inserted are added to
+        it, mapped to "duplicate" or "failed". A lost connection or transient
+        error that outlasted its retries is not raised but returned in
+        result["error"], with the rows left unwritten counted as failed. '''
         if collection is None:
             raise Exception("Collection not specified")
-        else:
-            if data is not None:
-                try:
-                    self.database[collection].insert_many(data, ordered=False, bypass_document_validation=True) # data should be dictionary
-                    return True # success
-                except errors.DuplicateKeyError:
-                    pass
-                except errors.ConnectionFailure:
-                    print("Connection lost")
-                    sys.exit(1)
-                except:
-                    #print(str(e))
-                    pass
-            else:
-                raise Exception("Nothing to save, because data parameter is empty")
-            # insert failed
-            return False
+        if data is None:
+            raise Exception("Nothing to save, because data parameter is empty")
+
+        with self.__writing(collection):
+            targets = self.routing.nodesFor(collection)
+            if len(targets) == 1:
+                return self.writer.write(self.databases[targets[0]][collection], data, rejected)
+
+            # Split the batch by node, then write each part
+            parts = {}
+            for index, document in enumerate(data):
+                parts.setdefault(self.routing.nodeFor(collection, document), []).append(index)
+            result = {"inserted": 0, "duplicates": 0, "failed": 0, "batches": 0, "retries": 0, "error": None}
+            for node, indexes in parts.items():
+                missed = {} if rejected is not None else None
+                counts = self.writer.write(self.databases[node][collection], [data[i] for i in indexes], missed)
+                # The other nodes are still written; the first error is reported
+                error = counts.pop("error")
+                if result["error"] is None:
+                    result["error"] = error
+                for key, value in counts.items():
+                    result[key] += value
+                if missed:
+                    rejected.update((indexes[i], reason) for i, reason in missed.items())
+            return result
+
+
+    def upsertRollups(self, updates):
+        ''' Apply RollupAccumulator.updates() to the rollup collection as upserts '''
+        if not updates:
+            return
+        self.ensureIndex(collection=ROLLUP_COLLECTION, index=[(k, 1) for k in ROLLUP_KEY])
+        with self.__writing(ROLLUP_COLLECTION):
+            for node, target in self.__targets(ROLLUP_COLLECTION):
+                for query, changes in updates:
+                    try:
+                        target.update_one(query, changes, upsert=True)
+                    except errors.DuplicateKeyError:
+                        # Another writer created the bucket first; now it exists, so this updates it
+                        target.update_one(query, changes, upsert=True)
+
+
+    def readRollupRanges(self, filename):
+        ''' Row ranges of filename already folded into the rollups '''
+        marker = next(iter(self.iterRead(collection=ROLLUP_RANGES, data={"_id": filename})), None)
+        return marker["ranges"] if marker else []
+
+
+    def addRollupRange(self, filename, start, end, skipped=()):
+        with self.__writing(ROLLUP_RANGES):
+            for node, target in self.__targets(ROLLUP_RANGES):
+                target.update_one({"_id": filename},
+                                  {"$push": {"ranges": {"start": start, "end": end, "skipped": list(skipped)}}},
+                                  upsert=True)
+
+
+    def removeRollupRange(self, filename, start, end, skipped=()):
+        with self.__writing(ROLLUP_RANGES):
+            for node, target in self.__targets(ROLLUP_RANGES):
+                target.update_one({"_id": filename},
+                                  {"$pull": {"ranges": {"start": start, "end": end, "skipped": list(skipped)}}})
+
 
+    def readRollups(self, collection=None, start=None, end=None, owner=None, system=None, granularity="hour"):
+        ''' Rollup documents for collection whose bucket starts in [start, end),
+        oldest first. Each has count, first, last and fields {name: {count, sum, min, max}}. '''
+        if collection is None:
+            raise Exception("Collection not specified")
+        if granularity not in GRANULARITIES:
+            raise Exception("Granularity must be one of {0}".format(", ".join(GRANULARITIES)))
+
+        query = {"collection": collection, "granularity": granularity}
+        bucket = {}
+        if start is not None:
+            bucket["$gte"] = start
+        if end is not None:
+            bucket["$lt"] = end
+        if bucket:
+            query["bucket"] = bucket
+        if owner is not None:
+            query["owner"] = owner
+        if system is not None:
+            query["system"] = system
+        return self.read(collection=ROLLUP_COLLECTION, data=query, sort=[("bucket", 1)])
+
+
+    def summarize(self, collection=None, start=None, end=None, owner=None, system=None, granularity="hour",
+                  groupBy=("owner", "system")):
+        ''' Time-range summary served from the rollups rather than the raw rows:
+        one entry per groupBy value with count, first, last and per-field
+        count/sum/min/max/mean. Buckets are selected by their start time, so use
+        a granularity that divides start and end. '''
+        rollups = self.readRollups(collection=collection, start=start, end=end, owner=owner,
+                                   system=system, granularity=granularity)
+        return mergeRollups(rollups, groupBy)
+
+
+    def read(self, collection=None, data=None, projection=None, sort=None, maxTimeMS=None):
+        ''' Query collection in database. Errors are raised, not returned.
+        Served from the cache when enableCache() is on; cached documents are
+        shared, so don't modify them. '''
+        cache = self.cache
+        if cache is not None and collection is not None:
+            key = cache.key(collection, data, projection, sort)
+            documents = cache.get(key)
+            if documents is not None:
+                return documents
+            generation = cache.generation(collection)
 
-    def read(self, collection=None, data=dict()):
-        ''' Query collection in database '''
+        documents = list(self.iterRead(collection=collection, data=data, projection=projection,
+                                       sort=sort, maxTimeMS=maxTimeMS)) # list of dicts
+
+        if cache is not None and collection is not None:
+            cache.put(key, documents, generation)
+        return documents
+
+
+    def iterRead(self, collection=None, data=None, projection=None, sort=None, batchSize=None, maxTimeMS=None, limit=0,
+                 allFields=False):
+        ''' Lazily iterate over matching documents, batchSize at a time from the server.
+        A collection spread over several nodes is read from all of them, merged
+        in order when sort uses a single direction. With no projection _id is
+        left out, unless allFields asks for whole documents. '''
         if collection is None:
             raise Exception("Collection not specified")
+        if projection is None and not allFields:
+            projection = {"_id": False}
+
+        cursors = []
+        for node, target in self.__targets(collection):
+            cursor = target.find(data or {}, projection, limit=limit)
+            if sort:
+                cursor = cursor.sort(sort)
+            if batchSize:
+                cursor = cursor.batch_size(batchSize)
+            if maxTimeMS:
+                cursor = cursor.max_time_ms(maxTimeMS)
+            cursors.append(cursor)
+
+        if len(cursors) == 1:
+            return cursors[0]
+
+        directions = set(direction for key, direction in sort) if sort else set()
+        if len(directions) == 1:
+            keys = [key for key, direction in sort]
+            merged = heapq.merge(*cursors, key=lambda doc: tuple(_sortKey(doc.get(k)) for k in keys),
+                                 reverse=directions.pop() < 0)
         else:
-            try:
-                return list(self.database[collection].find(data,{"_id":False})) # list of dicts
-            except Exception as e:
-                return(str(e))
+            merged = itertools.chain(*cursors)
+        return itertools.islice(merged, limit) if limit else merged
+
+
+    def readPage(self, collection=None, data=None, pageSize=1000, after=None, key="date", projection=None, maxTimeMS=None):
+        ''' Keyset pagination ordered by (key, _id).
+        Returns (documents, after); pass after back in to get the next page.
+        after is None once the last page has been read. '''
+        if collection is None:
+            raise Exception("Collection not specified")
+
+        query = data or {}
+        if after is not None:
+            value, lastId = after
+            query = {"$and": [query, {"$or": [
+                {key: {"$gt": value}},
+                {key: value, "_id": {"$gt": lastId}},
+            ]}]}
+
+        # The page boundary needs key and _id whatever the caller projected
+        if projection:
+            projection = dict(projection)
+            if any(v for k, v in projection.items() if k != "_id"):
+                projection[key] = True
+            else:
+                projection.pop(key, None)
+            # _id comes back in either kind of projection unless it is excluded
+            projection.pop("_id", None)
+
+        # An empty projection is not "everything": pymongo 3.x sends {} as {"_id": 1}
+        documents = list(self.iterRead(collection=collection, data=query, projection=projection or None,
+                                       sort=[(key, 1), ("_id", 1)], batchSize=pageSize,
+                                       maxTimeMS=maxTimeMS, limit=pageSize, allFields=not projection))
+        if len(documents) < pageSize:
+            return documents, None
+        last = documents[-1]
+        return documents, (last.get(key), last["_id"])
 
     
     # update data in collection
     # dict(query) = What is being changed
     # dict(changes) = What the query is being replaced with
-    def update(self, collection=None, data=None, changes=None):
-        ''' Update data in a collection '''
+    def update(self, collection=None, data=None, changes=None, upsert=False):
+        ''' Update data in a collection. Returns one result per node when the
+        collection is spread over several. '''
         if collection is None:
             raise Exception("Collection not specified")
         else:
             if data is not None and changes is not None:
                 try:
-                    cmd = self.database[collection].update_many(data, { "$set": changes })
-                    return cmd # json
+                    with self.__writing(collection):
+                        cmds = [target.update_many(data, { "$set": changes }, upsert=upsert)
+                                for node, target in self.__targets(collection)]
+                    return cmds[0] if len(cmds) == 1 else cmds # json
                 except Exception as e:
                     return(str(e))
             else:
                 raise Exception("Query and/or update arguments are empty")
 
 
-    def createIndex(self, collection=None, index=None):
+    def createIndex(self, collection=None, index=None, unique=True):
+        if index is None:
+            raise Exception("Index not specified")
+        if collection is None:
+            raise Exception("Collection not specified")
+        for node, target in self.__targets(collection):
+            target.create_index(index, unique=unique)
+
+
+    def ensureIndex(self, collection=None, index=None, unique=True):
+        ''' Create an index unless this driver already knows it exists.
+        list_indexes is consulted once per collection, after which repeat
+        calls cost a dict lookup instead of a server round trip. '''
         if index is None:
             raise Exception("Index not specified")
         if collection is None:
             raise Exception("Collection not specified")
-        self.database[collection].create_index(index, unique=True)
+        if isinstance(index, str):
+            index = [(index, 1)]
+        name = "_".join("{0}_{1}".format(key, direction) for key, direction in index)
+        created = False
+
+        with self.__indexLock:
+            for node, target in self.__targets(collection):
+                known = self.__indexes.get((node, collection))
+                if known is None:
+                    known = set(x["name"] for x in target.list_indexes())
+                    self.__indexes[(node, collection)] = known
+                if name in known:
+                    self.metrics.inc("index_cache_hits")
+                    continue
+                self.metrics.inc("index_cache_misses")
+                target.create_index(index, unique=unique, name=name)
+                known.add(name)
+                created = True
+        return created
+
+
+    def invalidateIndexes(self, collection=None):
+        ''' Forget cached index state, e.g. after a collection is dropped.
+        With no collection every entry is cleared. '''
+        with self.__indexLock:
+            if collection is None:
+                self.__indexes.clear()
+            else:
+                for key in [k for k in self.__indexes if k[1] == collection]:
+                    del self.__indexes[key]
 
 
     # dict(query) = Key/value pairs describing document(s) to delete
@@ -92,27 +428,154 @@ class CustomMongodbDriver(object):
         else:
             if query is not None:
                 try:
-                    cmd = self.database[collection].delete_many(query)
-                    return cmd.raw_result # json
+                    with self.__writing(collection):
+                        results = [target.delete_many(query).raw_result for node, target in self.__targets(collection)]
+                    if len(results) == 1:
+                        return results[0] # json
+                    return {"n": sum(r.get("n", 0) for r in results), "ok": 1.0, "nodes": results}
                 except Exception as e:
                     return(str(e))
             else:
                 raise Exception("Query argument is empty")
 
 
-class CustomMongodbFileProcessor():
+def _sortKey(value):
+    # None sorts first, like MongoDB, and never gets compared to other types
+    return (value is not None, value)
+
+
+class _IngestTracker(object):
+    ''' Counts outstanding chunks per file so a file is only marked as
+    ingested once its last chunk has been written. onFailed(filename, parsed)
+    is told whether a failed file was read to the end. '''
+
+    def __init__(self, onFailed=None):
+        self.__lock = threading.Lock()
+        self.__files = {}
+        self.onFailed = onFailed
+
+    def reserve(self, filename):
+        ''' Hold filename from the moment it is queued until it finishes '''
+        with self.__lock:
+            self.__files.setdefault(filename, None)
+
+    def holds(self, filename):
+        with self.__lock:
+            return filename in self.__files
+
+    def open(self, filename, entry):
+        with self.__lock:
+            if self.__files.get(filename) is not None:
+                # Its chunks would be counted against the run in flight
+                raise Exception("{0} is already being ingested".format(filename))
+            self.__files[filename] = {"pending": 0, "closed": False, "entry": entry}
+
+    def add(self, filename):
+        with self.__lock:
+            self.__files[filename]["pending"] += 1
+
+    def close(self, filename, ok=True, readable=True):
+        ''' Called once the producer has queued every chunk. Returns the
+        manifest entry if the file is complete and should be marked now.
+        readable is False when the file itself could not be parsed. '''
+        with self.__lock:
+            entry = self.__files[filename]
+            if not ok:
+                entry["failed"] = True
+            if not readable:
+                entry["unreadable"] = True
+            entry["closed"] = True
+            return self.__finish(filename, entry)
+
+    def commit(self, filename, ok=True):
+        ''' Called after a chunk is written. Returns the manifest entry if that was the last one. '''
+        with self.__lock:
+            entry = self.__files[filename]
+            if not ok:
+                entry["failed"] = True
+            entry["pending"] -= 1
+            return self.__finish(filename, entry)
+
+    def __finish(self, filename, entry):
+        if entry["closed"] and entry["pending"] == 0:
+            del self.__files[filename]
+            if not entry.get("failed", False):
+                return entry["entry"]
+            if self.onFailed:
+                self.onFailed(filename, not entry.get("unreadable", False))
+        return None
+
+
+class _DirectoryWatcher(object):
+    ''' Wakes serve() early on inotify events when inotify_simple is
+    installed; otherwise it just sleeps between polls '''
+
+    def __init__(self):
+        self.__watched = set()
+        self.__inotify = None
+        if inotify_simple is not None:
+            try:
+                self.__inotify = inotify_simple.INotify()
+            except OSError:
+                self.__inotify = None
+
+    def add(self, directory):
+        if self.__inotify is None or directory in self.__watched:
+            return
+        flags = inotify_simple.flags
+        try:
+            self.__inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE)
+            self.__watched.add(directory)
+        except OSError:
+            pass
+
+    def wait(self, seconds, stopping):
+        if self.__inotify is None:
+            stopping.wait(seconds)
+            return
+        # Short slices so stop() is noticed promptly
+        deadline = time.time() + seconds
+        while not stopping.is_set() and time.time() < deadline:
+            if self.__inotify.read(timeout=int(min(0.5, seconds) * 1000)):
+                return
+
+    def close(self):
+        if self.__inotify is not None:
+            self.__inotify.close()
+
+
+class CustomMongodbFileProcessor(IngestSettings):
 
     def __init__(self, driver):
         self.__db = driver
-        self.__ignore_first_header = False
-        self.__overwrite = False
+        IngestSettings.__init__(self)
+        self.__backend = createParseBackend("thread")
+        self.__chunk_size = None
+        self.__manifest_digest = False
+        self.__progress = True
+        self.__observer = None
+        self.__profiler = None
+        self.__metrics_export = None
+        self.__rollups = None
+
+        self.metrics = Metrics(prefix="healthandstatus_ingest")
+        self.metrics.gauge("file_queue_depth", lambda: self.fileQueue.qsize())
+        self.metrics.gauge("writer_queue_depth", lambda: self.dbWriterQueue.qsize())
+        self.__tracker = _IngestTracker(onFailed=self.__forget)
+        # filename -> (size, mtime) of files known to be ingested or queued (serve mode)
+        self.__seen = {}
+        self.__stopping = threading.Event()
         
         self.dbWriterQueue = queue.Queue()
         
         self.__queue = {}
+        self.__resultsLock = threading.Lock()
         self.__results = {
             "files": 0,
             "total_rows": 0,
+            "inserted": 0,
+            "duplicates": 0,
+            "failed": 0,
         }
 
         self.src = ""
@@ -120,69 +583,247 @@ class CustomMongodbFileProcessor():
         self.sep = ""
         self.traits = []
     
-    def setOverwrite(self, value):
-        if isinstance(value, bool):
-            self.__overwrite = value
+    def setParseBackend(self, backend, workers=None):
+        ''' Choose how files are parsed: "thread", "process" or a backend object '''
+        if isinstance(backend, str):
+            self.__backend = createParseBackend(backend, workers)
+        elif hasattr(backend, "parse"):
+            self.__backend = backend
         else:
-            raise Exception("Overwrite value must be True or False")
+            raise Exception("Parse backend must be 'thread', 'process' or a backend object")
+
+
+    def setChunkSize(self, value):
+        ''' Stream files to the writers in chunks of this many rows (None = whole file) '''
+        if value is None or (isinstance(value, int) and value > 0):
+            self.__chunk_size = value
+        else:
+            raise Exception("Chunk size must be a positive integer or None")
+
+
+    def setQueueDepth(self, value):
+        ''' Bound the writer queue so parsing blocks while the writers catch up.
+        Peak memory is roughly chunk size * (queue depth + parse workers). '''
+        if value is None or (isinstance(value, int) and value > 0):
+            self.dbWriterQueue = queue.Queue(maxsize=value or 0)
+        else:
+            raise Exception("Queue depth must be a positive integer or None")
 
 
     def bulkWriterThread(self, db, name):
         while True:
             try:        
                 item = self.dbWriterQueue.get(block=True)
+                if item is None:
+                    # Shutdown sentinel
+                    break
                 #print("bulkWriterThread #{0}: {1}".format(name, item["filename"]))
-                self.__db.create(collection=item["collection"], data=item["data"])
-                self.__db.create(collection="ingestedFiles", data=[{"filename": item["filename"]}])
-                self.dbWriterQueue.task_done()
+                ok = False
+                try:
+                    with self.__profiled():
+                        started = time.perf_counter()
+                        rejected = {} if self.__rollups else None
+                        result = self.__db.bulkCreate(collection=item["collection"], data=item["data"],
+                                                      rejected=rejected)
+                        self.__observe("insert", started, len(item["data"]))
+                        if result["error"] is not None:
+                            print(str(result["error"]))
+                        self.__addResults(inserted=result["inserted"], duplicates=result["duplicates"],
+                                          failed=result["failed"])
+                        ok = result["failed"] == 0
+                        if self.__rollups:
+                            self.__rollup(item, rejected)
+                except Exception as e:
+                    print(str(e))
+                    self.__addResults(failed=len(item["data"]))
+                finally:
+                    # A file with any failed rows is left unmarked so the next run retries it
+                    entry = self.__tracker.commit(item["filename"], ok)
+                    if entry:
+                        self.__markIngested(entry)
             except:
                 pass
+            finally:
+                self.dbWriterQueue.task_done()
+
 
+    def __rollup(self, item, rejected):
+        # Each file records which of its rows have been rolled up, so a row is
+        # counted once however often its file is re-ingested or retried. Rows
+        # inserted now are new to the collection and always count, whatever
+        # was recorded for an earlier version of the file. A duplicate counts
+        # only where no range covers it: it landed on an earlier attempt whose
+        # batch was never rolled up.
+        started = time.perf_counter()
+        filename, data, offset = item["filename"], item["data"], item["offset"]
+        failed = set(i for i, reason in rejected.items() if reason == "failed")
+        if len(failed) == len(data):
+            return
+        recorded = False
+        try:
+            covered = coveredRows(self.__db.readRollupRanges(filename), offset, offset + len(data))
+            skip = set(failed)
+            duplicates = [i for i, reason in rejected.items() if reason == "duplicate"]
+            skip.update(i for i in duplicates if offset + i in covered)
+            # A line repeated within the chunk is one row in the collection
+            if duplicates:
+                seen = set()
+                for i, doc in enumerate(data):
+                    key = doc.get("_id", doc.get("hash"))
+                    if key in seen and rejected.get(i) == "duplicate":
+                        skip.add(i)
+                    seen.add(key)
 
-    def setIgnoreFirstHeader(self, value):
+            # Re-ingesting rows already covered would only grow the ranges list
+            skipped = sorted(offset + i for i in failed)
+            if any(offset + i not in covered for i in range(len(data)) if i not in failed):
+                # Record first: a crash in between leaves the rollup short rather than double counted
+                self.__db.addRollupRange(filename, offset, offset + len(data), skipped)
+                recorded = True
+            if len(skip) < len(data):
+                accumulator = RollupAccumulator(item["collection"], self.__rollups)
+                self.__db.upsertRollups(accumulator.add(data, skip).updates())
+        except Exception as e:
+            print(str(e))
+            self.metrics.inc("rollup_failures", collection=item["collection"])
+            if recorded:
+                try:
+                    self.__db.removeRollupRange(filename, offset, offset + len(data), skipped)
+                except Exception as e:
+                    print(str(e))
+            return
+        self.__observe("rollup", started, len(data) - len(skip))
+
+
+    def setRollups(self, value, granularity="hour"):
+        ''' Keep per owner/system/time bucket summaries in the rollups collection
+        as rows are inserted; read them back with driver.summarize().
+        granularity is "minute", "hour", "day" or a list of them. '''
+        if not isinstance(value, bool):
+            raise Exception("Value must be True or False")
+        granularities = (granularity,) if isinstance(granularity, str) else tuple(granularity)
+        if not granularities or any(g not in GRANULARITIES for g in granularities):
+            raise Exception("Granularity must be one of {0}".format(", ".join(GRANULARITIES)))
+        self.__rollups = granularities if value else None
+
+
+    def setManifestDigest(self, value):
+        ''' Also record a content digest so touched-but-identical files are skipped '''
         if isinstance(value, bool):
-            self.__ignore_first_header = value
+            self.__manifest_digest = value
         else:
             raise Exception("Value must be True or False")
 
-    def __scanDir(self, src, traits):
-        q = queue.Queue()
 
-        # Get list of ingested files
-        ingestedFiles = [ x["filename"] for x in self.__db.read(collection="ingestedFiles") ]
+    def setProgress(self, value):
+        ''' Show progress bars while running (off for benchmarks and scripts) '''
+        if isinstance(value, bool):
+            self.__progress = value
+        else:
+            raise Exception("Value must be True or False")
 
-        # Store files we need to process
-        filesToProcess = []
 
-        for subdir, dirs, files in os.walk(src):
+    def setStageObserver(self, observer):
+        ''' observer(stage, seconds, rows) is called after each scan, read,
+        parse, insert and manifest step, from whichever thread ran it '''
+        if observer is not None and not callable(observer):
+            raise Exception("Observer must be callable")
+        self.__observer = observer
 
-            for file in files:
 
-                filename = os.path.join(subdir, file)
-                approved = True
+    def __observe(self, stage, started, rows=0, seconds=None):
+        if seconds is None:
+            seconds = time.perf_counter() - started
+        self.metrics.observe("stage_seconds", seconds, stage=stage)
+        if rows:
+            self.metrics.inc("rows", rows, stage=stage)
+        if self.__observer is not None:
+            self.__observer(stage, seconds, rows)
 
-                for trait in traits:
-                    if not trait in filename:
-                        approved = False
 
-                if approved:
+    def setProfiling(self, directory):
+        ''' Run each pipeline thread's work under cProfile and write
+        <directory>/<thread>.prof when start() finishes; on Python 3.12 and
+        later, where only one profiler can be active, the whole run goes to
+        <directory>/process.prof. A profiler that can't be enabled is counted
+        in profiler_errors and the work runs unprofiled. None turns profiling
+        off. The "hash" stage is timed either way. '''
+        self.__profiler = ThreadProfiler(directory) if directory else None
 
-                    try:
-                        filesToProcess.append(filename)
-                    except Exception as e:
-                        print(str(e))
-        
-        if not self.__overwrite:
+
+    @contextlib.contextmanager
+    def __profiled(self):
+        profile = self.__profiler.profile() if self.__profiler is not None else None
+        enabled = False
+        if profile is not None:
             try:
-                filesToProcess = list(set(filesToProcess) - set(ingestedFiles))
+                profile.enable()
+                enabled = True
             except Exception as e:
+                # e.g. another profiling tool is active; the work matters more than its profile
                 print(str(e))
-                pass
+                self.metrics.inc("profiler_errors")
+        try:
+            yield
+        finally:
+            if enabled:
+                profile.disable()
+
+
+    def exportMetrics(self, format="json"):
+        ''' Processor and driver metrics as JSON or Prometheus text '''
+        if format == "json":
+            return toJSON(self.metrics, self.__db.metrics)
+        if format == "prometheus":
+            return toPrometheus(self.metrics, self.__db.metrics)
+        raise Exception("Format must be 'json' or 'prometheus'")
+
+
+    def setMetricsExport(self, path, interval=5, format="json"):
+        ''' Rewrite path with exportMetrics(format) every interval seconds while
+        running, e.g. for the node_exporter textfile collector. None turns it off. '''
+        if path is None:
+            self.__metrics_export = None
+            return
+        if format not in ("json", "prometheus"):
+            raise Exception("Format must be 'json' or 'prometheus'")
+        self.__metrics_export = {"path": path, "interval": interval, "format": format}
+
+
+    def __writeMetrics(self):
+        export = self.__metrics_export
+        if export:
+            try:
+                writeAtomic(export["path"], self.exportMetrics(export["format"]))
+            except Exception as e:
+                print(str(e))
+
+
+    def metricsExportThread(self, stop):
+        while not stop.wait(self.__metrics_export["interval"]):
+            self.__writeMetrics()
 
-        for item in filesToProcess:
-            q.put(item)
 
+    def __scanDir(self, src, traits):
+        q = queue.Queue()
+        started = time.perf_counter()
+
+        # Indexed lookup of recorded entries, one directory batch at a time
+        self.__db.ensureIndex(collection="ingestedFiles", index=[("filename", 1)], unique=False)
+
+        lookup = None if self._overwrite else self.__lookupIngested
+
+        for entry in scanTree(src, traits, lookup=lookup, digest=self.__manifest_digest, refresh=self.__markIngested):
+            q.put(entry)
+
+        self.__observe("scan", started)
         return q
+
+
+    def __lookupIngested(self, filenames):
+        known = self.__db.iterRead(collection="ingestedFiles", data={"filename": {"$in": filenames}},
+                                   batchSize=len(filenames))
+        return {x["filename"]: x for x in known}
                     
 
     def start(self, src=None, splitchar="_", sep=",", traits=[]):
@@ -191,11 +832,10 @@ class CustomMongodbFileProcessor():
         self.sep = sep
         self.traits = traits
 
+        # Rates are reported per run
+        self.metrics.reset()
         self.fileQueue = self.__scanDir(self.src, self.traits)
 
-        self.fileThreads = []
-        self.dbThreads = []
-
         self.fileProgressBar = None
         self.dbWriterProgressBar = None
 
@@ -208,19 +848,10 @@ class CustomMongodbFileProcessor():
         self.fileProgressBar = progressbar.ProgressBar(maxval=self.fileQueue.qsize(), \
                                     widgets=["Parsing files: ", progressbar.SimpleProgress(), ' ', progressbar.Percentage(), ' ', progressbar.ETA()])
 
-        # Spawn 3 threads to process files
-        for i in range(3):
-            t = threading.Thread(target=self.processFolder, args=(i,), daemon=True)
-            self.fileThreads.append(t)
-            t.start()
+        self.metrics.inc("files_queued", self.fileQueue.qsize())
+        self.__startPipeline()
 
-        # Start 3 bulk writer threads
-        for i in range(3):
-            t = threading.Thread(target=self.bulkWriterThread, args=(self.__db, i,), daemon=True)
-            self.dbThreads.append(t)
-            t.start()
-
-        if not self.fileQueue.empty():
+        if self.__progress and not self.fileQueue.empty():
             self.fileProgressBar.start()
             while not self.fileQueue.empty():
                 self.fileProgressBar.update(self.fileProgressBar.maxval-self.fileQueue.qsize())
@@ -239,9 +870,180 @@ class CustomMongodbFileProcessor():
                     time.sleep(1)
                 self.dbWriterProgressBar.finish()
 
+        # Wait for in-flight files and batches before reporting
+        self.__stopPipeline()
         
+        self.__printResults()
+
+
+    def serve(self, src=None, splitchar="_", sep=",", traits=[], interval=2.0, settle=2.0, handleSignals=True):
+        ''' Run as a resident service: keep the workers, index cache and
+        manifest warm and ingest files as they land until stop() is called or
+        SIGINT/SIGTERM arrives, then drain queued work and return.
+
+        The tree is re-walked every interval seconds (sooner on inotify events
+        when inotify_simple is installed). A file is queued once its size and
+        mtime have stayed the same for settle seconds, so half-written files
+        are left alone. '''
+        self.src = src
+        self.splitchar = splitchar
+        self.sep = sep
+        self.traits = traits
+        self.fileQueue = queue.Queue()
+        self.__stopping.clear()
+
+        self.metrics.reset()
+        self.__db.ensureIndex(collection="ingestedFiles", index=[("filename", 1)], unique=False)
+        self.__startPipeline()
+        watcher = _DirectoryWatcher()
+        pending = {}
+        previous = {}
+
+        try:
+            # Installed only once there is a pipeline for the finally below to stop
+            if handleSignals and threading.current_thread() is threading.main_thread():
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    previous[sig] = signal.signal(sig, lambda signum, frame: self.stop())
+
+            while not self.__stopping.is_set():
+                started = time.perf_counter()
+                try:
+                    self.__poll(src, traits, settle, pending, watcher)
+                except Exception as e:
+                    # A database blip or a file vanishing mid-poll; the next pass retries
+                    print(str(e))
+                    self.metrics.inc("poll_errors")
+                self.__observe("scan", started)
+                self.metrics.gauge("files_pending", len(pending))
+
+                # Re-check soon while anything is settling
+                wait = min(interval, settle / 2.0) if pending else interval
+                watcher.wait(wait, self.__stopping)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            watcher.close()
+            self.__stopPipeline()
+            self.__printResults()
+
+
+    def __poll(self, src, traits, settle, pending, watcher):
+        ''' One pass over the tree: settle new and changed files, queue the settled ones '''
+        lookup = None if self._overwrite else self.__lookupIngested
+        now = time.time()
+        found = set()
+
+        for entry in scanTree(src, traits, lookup=lookup, refresh=self.__markIngested,
+                              cache=self.__seen, onDirectory=watcher.add):
+            filename = entry["filename"]
+            found.add(filename)
+            stat = (entry["size"], entry["mtime"])
+            if filename not in pending or pending[filename][0] != stat:
+                # New, or still being written; restart the settle clock
+                pending[filename] = (stat, now, entry)
+            elif self.__tracker.holds(filename):
+                # Changed while an earlier copy is in flight; wait for that to finish
+                continue
+            elif now - pending[filename][1] >= settle:
+                del pending[filename]
+                self.__queueSettled(entry)
+
+        # Forget pending files that vanished
+        for filename in [f for f in pending if f not in found]:
+            del pending[filename]
+
+
+    def stop(self):
+        ''' Ask serve() to finish queued work and return '''
+        self.__stopping.set()
+
+
+    def __queueSettled(self, entry):
+        filename = entry["filename"]
+        if self.__manifest_digest:
+            entry["digest"] = fileDigest(filename)
+            previous = {} if self._overwrite else self.__lookupIngested([filename])
+            if filename in previous and previous[filename].get("digest") == entry["digest"]:
+                # Touched but identical
+                self.__markIngested(entry)
+                self.__seen[filename] = (entry["size"], entry["mtime"])
+                return
+        self.__seen[filename] = (entry["size"], entry["mtime"])
+        self.metrics.inc("files_queued")
+        self.__tracker.reserve(filename)
+        self.fileQueue.put(entry)
+
+
+    def __forget(self, filename, parsed=True):
+        if parsed:
+            # Only the write failed; pick it up again on the next serve() pass
+            self.__seen.pop(filename, None)
+        else:
+            # Re-reading won't help until the file changes, and a changed
+            # size or mtime makes the scan find it again
+            self.metrics.inc("files_unreadable")
+
+
+    def __startPipeline(self):
+        self.fileThreads = []
+        self.dbThreads = []
+
+        self.__backend.start()
+
+        if self.__profiler is not None:
+            try:
+                self.__profiler.start()
+            except Exception as e:
+                print(str(e))
+                self.metrics.inc("profiler_errors")
+
+        self.__stopExport = threading.Event()
+        if self.__metrics_export:
+            t = threading.Thread(target=self.metricsExportThread, args=(self.__stopExport,), name="metrics", daemon=True)
+            t.start()
+
+        # One feeder thread per parse worker keeps every worker busy
+        for i in range(self.__backend.workers):
+            t = threading.Thread(target=self.processFolder, args=(i,), name="parser-{0}".format(i), daemon=True)
+            self.fileThreads.append(t)
+            t.start()
+
+        # Start 3 bulk writer threads
+        for i in range(3):
+            t = threading.Thread(target=self.bulkWriterThread, args=(self.__db, i,), name="writer-{0}".format(i), daemon=True)
+            self.dbThreads.append(t)
+            t.start()
+
+
+    def __stopPipeline(self):
+        ''' Drain both queues, then stop the threads and the parse backend '''
+        self.fileQueue.join()
+        for t in self.fileThreads:
+            self.fileQueue.put(None)
+        for t in self.fileThreads:
+            t.join()
+
+        self.dbWriterQueue.join()
+        for t in self.dbThreads:
+            self.dbWriterQueue.put(None)
+        for t in self.dbThreads:
+            t.join()
+
+        self.__backend.shutdown()
+
+        self.__stopExport.set()
+        self.__writeMetrics()
+        if self.__profiler is not None:
+            self.__profiler.stop()
+            self.__profiler.dump()
+
+
+    def __printResults(self):
         print("\nTotal files:        {0}".format(self.__results["files"]))
         print("Total rows of data: {0}".format(self.__results["total_rows"]))
+        print("Rows inserted:      {0}".format(self.__results["inserted"]))
+        print("Duplicate rows:     {0}".format(self.__results["duplicates"]))
+        print("Failed rows:        {0}".format(self.__results["failed"]))
 
         print("\nFinished.")      
 
@@ -249,84 +1051,103 @@ class CustomMongodbFileProcessor():
     def processFolder(self, name):
         while True:
             try:
-                filename = self.fileQueue.get(block=True)
-                #print("fileProcessThread #{0}: {1}".format(name, filename))
-                self.__parseAndAdd(filename, self.splitchar, self.sep)
-                self.fileQueue.task_done()
+                entry = self.fileQueue.get(block=True)
+                if entry is None:
+                    # Shutdown sentinel
+                    self.fileQueue.task_done()
+                    break
+                #print("fileProcessThread #{0}: {1}".format(name, entry["filename"]))
+                try:
+                    with self.__profiled():
+                        self.__parseAndAdd(entry, self.splitchar, self.sep)
+                finally:
+                    self.fileQueue.task_done()
             except Exception as e:
                 print(str(e))
                 pass
 
 
-    def __parseAndAdd(self, filename, splitchar, sep):
-        queue = {}
+    def __parseAndAdd(self, entry, splitchar, sep):
+        filename = entry["filename"]
+        self.__tracker.open(filename, entry)
+        ok = False
+        readable = True
+        rows = 0
 
-        # Tally number of files added to database
         try:
-            # Get info from filename
-            basename = os.path.basename(filename)
-            parts = basename.split(splitchar)
-            owner = parts[0]
-            collection = parts[1]
-            system = parts[2]
-            filedate = self.__parseDate(os.path.splitext(parts[3])[0])
-            
-            # Create unique index of hash column
-            self.__db.createIndex(collection=collection, index=[("hash", 'text')])
-
-            queue["collection"] = collection
-            queue["filename"] = filename
-            queue["data"] = []
-
-            # Read file
-            with open(filename, 'r') as file:
-                headers = False
-                
-                for line in file:
-                    
-                    line = line.strip("\n")
+            info = parseFilename(filename, splitchar)
+            collection = info["collection"]
 
-                    if not line:
-                        continue
-                    
-                    line = line.split(sep)
-
-                    if not headers:
-                        # First line contains headers
-                        if self.__ignore_first_header:
-                            headers = line[1:]
-                        else:
-                            headers = line
-                        
-                        #print("Headers: {0}".format(headers))
-                        continue
-                    
+            if not self._idAlgorithm:
+                # Create unique index of hash column
+                self.__db.ensureIndex(collection=collection, index=[("hash", 'text')])
 
-                    data = {headers[i]: line[i].strip() for i in range(0,len(headers))}
+            # Read the file a chunk at a time; put() blocks while the writer queue is full.
+            # Remote (process) workers get byte ranges to read themselves and
+            # usually send documents back as BSON.
+            remote = getattr(self.__backend, "remote", False)
+            chunks, parser = self._openChunks(filename, sep, self.__chunk_size, spans=remote)
+            schema = None
+            started = time.perf_counter()
+            for headers, lines in chunks:
+                self.__observe("read", started)
+                if remote:
+                    self.metrics.inc("bytes_read", lines[2] - lines[1])
+                else:
+                    self.metrics.inc("bytes_read", sum(map(len, lines)) + len(lines))
+                if schema is None:
+                    schema = self._resolveSchema(collection, headers, lines, sep)
+                started = time.perf_counter()
+                # Hashing is timed per chunk in the worker
+                if remote and getattr(self.__backend, "encode", False):
+                    data, stats = self.__backend.parse(parseEncoded, parser, info, headers, lines, sep,
+                                                       self._idAlgorithm, schema)
+                    data = decodeDocuments(data)
+                else:
+                    data, stats = self.__backend.parse(parseTimed, parser, info, headers, lines, sep,
+                                                       self._idAlgorithm, schema)
+                if not data:
+                    # Only blank lines in this range
+                    started = time.perf_counter()
+                    continue
+                self.__observe("hash", started, seconds=stats["hash"])
+                self.__observe("parse", started, len(data))
+                self.__tracker.add(filename)
+                self.dbWriterQueue.put({"collection": collection, "filename": filename, "data": data,
+                                        "offset": rows})
+                rows += len(data)
+                started = time.perf_counter()
 
-                    # Add identifying information
-                    data["owner"] = owner
-                    data["system"] = system
-                    data["date"] = filedate
+            ok = True
+        except Exception as e:
+            print("{0}: {1}".format(filename, str(e)))
+            # Database trouble is worth retrying; a bad name or row is not
+            readable = isinstance(e, errors.PyMongoError)
+        finally:
+            self.__addResults(files=1 if ok else 0, rows=rows)
+            entry = self.__tracker.close(filename, ok, readable)
+            if entry:
+                self.__markIngested(entry)
 
-                    # create string to hash
-                    unhashed_string = "{}_{}".format(line, basename).encode('utf-8')
-                    # hash line+filename
-                    data["hash"] = hashlib.md5(unhashed_string).hexdigest()
-                    
-                    queue["data"].append(data)
-                    self.__results["total_rows"] += 1
-            
-            self.dbWriterQueue.put(queue) 
-            self.__results["files"] += 1   
+        return ok
 
-            return True
-        except Exception as e:
-            print(str(e))
 
-        return False
-    
+    def __markIngested(self, entry):
+        started = time.perf_counter()
+        self.__db.update(collection="ingestedFiles", data={"filename": entry["filename"]}, changes=entry, upsert=True)
+        self.__observe("manifest", started)
+
+
+    def getResults(self):
+        ''' Copy of the run totals: files, total_rows, inserted, duplicates, failed '''
+        with self.__resultsLock:
+            return dict(self.__results)
+
 
-    def __parseDate(self, date_str):
-        # 2021.03.30.01.05.08
-        return datetime.datetime.strptime(date_str, "%Y.%m.%d.%H.%M.%S")
+    def __addResults(self, files=0, rows=0, inserted=0, duplicates=0, failed=0):
+        with self.__resultsLock:
+            self.__results["files"] += files
+            self.__results["total_rows"] += rows
+            self.__results["inserted"] += inserted
+            self.__results["duplicates"] += duplicates
+            self.__results["failed"] += failed
@@ -0,0 +1,356 @@
+from bson.raw_bson import RawBSONDocument
+from concurrent.futures import ProcessPoolExecutor
+import bson
+import datetime
+import hashlib
+import mmap
+import os
+import time
+
+from .schema import compileSchema, convertColumn
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+HASH_ALGORITHMS = ("blake2b", "xxhash", "md5")
+
+_hashers = {}
+
+
+def parseDate(date_str):
+    # 2021.03.30.01.05.08
+    return datetime.datetime.strptime(date_str, "%Y.%m.%d.%H.%M.%S")
+
+
+def parseFilename(filename, splitchar):
+    ''' Split owner_collection_system_DTG.dat into its identifying parts '''
+    basename = os.path.basename(filename)
+    parts = basename.split(splitchar)
+    return {
+        "basename": basename,
+        "owner": parts[0],
+        "collection": parts[1],
+        "system": parts[2],
+        "date": parseDate(os.path.splitext(parts[3])[0]),
+    }
+
+
+def createHasher(algorithm):
+    ''' Return a function mapping bytes to a compact 16 byte binary digest '''
+    hasher = _hashers.get(algorithm)
+    if hasher is not None:
+        return hasher
+    if algorithm == "blake2b":
+        hasher = lambda value: hashlib.blake2b(value, digest_size=16).digest()
+    elif algorithm == "xxhash":
+        if xxhash is None:
+            raise Exception("xxhash is not installed")
+        hasher = xxhash.xxh3_128_digest
+    elif algorithm == "md5":
+        hasher = lambda value: hashlib.md5(value).digest()
+    else:
+        raise Exception("Unknown hash algorithm: {0}".format(algorithm))
+    _hashers[algorithm] = hasher
+    return hasher
+
+
+def readChunks(filename, sep, ignoreFirstHeader=False, chunkSize=None):
+    ''' Yield (headers, lines) for a .dat file, chunkSize data lines at a time.
+    With no chunkSize the whole file comes back as a single chunk. '''
+    with open(filename, 'r') as file:
+        headers = False
+        lines = []
+
+        for line in file:
+
+            line = line.strip("\n")
+
+            if not line:
+                continue
+
+            if not headers:
+                # First line contains headers
+                headers = line.split(sep)
+                if ignoreFirstHeader:
+                    headers = headers[1:]
+                continue
+
+            lines.append(line)
+
+            if chunkSize and len(lines) >= chunkSize:
+                yield headers, lines
+                lines = []
+
+        if lines:
+            yield headers, lines
+
+
+def readBlocks(filename, sep, ignoreFirstHeader=False, chunkSize=None, window=1 << 20):
+    ''' Like readChunks, but the file is mmapped and taken a window of about
+    window bytes at a time, cut at a line end. Each window is decoded once and
+    split as text, so there is no per-line work in Python before parsing.
+    CRLF endings become LF, as in text mode. '''
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            headers = False
+            lines = []
+            pos = 0
+
+            while pos < size:
+                end = size
+                if pos + window < size:
+                    end = mm.rfind(b"\n", pos, pos + window) + 1
+                    if end <= pos:
+                        # A single line longer than the window
+                        end = mm.find(b"\n", pos + window) + 1 or size
+                new = _textLines(mm[pos:end].decode('utf-8'))
+                pos = end
+
+                if not headers and new:
+                    # First line contains headers
+                    headers = new[0].split(sep)
+                    if ignoreFirstHeader:
+                        headers = headers[1:]
+                    del new[0]
+                lines.extend(new)
+
+                if chunkSize and len(lines) >= chunkSize:
+                    first = 0
+                    while len(lines) - first >= chunkSize:
+                        yield headers, lines[first:first + chunkSize]
+                        first += chunkSize
+                    del lines[:first]
+
+            if lines:
+                yield headers, lines
+
+
+def _textLines(text):
+    # Non-empty lines of decoded text; CRLF endings become LF, as in text mode
+    if "\r" in text:
+        text = text.replace("\r\n", "\n")
+    return list(filter(None, text.split("\n")))
+
+
+def readSpans(filename, sep, ignoreFirstHeader=False, chunkSize=None, window=1 << 16):
+    ''' Yield (headers, (filename, start, end)) byte ranges holding up to
+    chunkSize data lines, for whoever parses them to read with spanLines.
+    Only the header line is decoded here; line ends are counted a window at
+    a time, so the caller does next to no work per row. '''
+    with open(filename, 'rb') as file:
+        size = os.fstat(file.fileno()).st_size
+        if size == 0:
+            return
+
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            headers = False
+            pos = 0
+
+            # First non-empty line contains headers
+            while pos < size and not headers:
+                end = mm.find(b"\n", pos)
+                if end < 0:
+                    end = size
+                line = mm[pos:end].decode('utf-8').rstrip("\r")
+                pos = end + 1
+                if line:
+                    headers = line.split(sep)
+                    if ignoreFirstHeader:
+                        headers = headers[1:]
+
+            while pos < size:
+                end = _lineEnd(mm, pos, size, chunkSize, window) if chunkSize else size
+                yield headers, (filename, pos, end)
+                pos = end
+
+
+def _lineEnd(mm, pos, size, lines, window):
+    # Offset just past the lines-th line end from pos, or size if there are fewer
+    while pos < size:
+        block = mm[pos:pos + window]
+        count = block.count(b"\n")
+        if count >= lines:
+            cut = -1
+            for i in range(lines):
+                cut = block.find(b"\n", cut + 1)
+            return pos + cut + 1
+        lines -= count
+        pos += len(block)
+    return size
+
+
+def spanLines(span, limit=None):
+    ''' The non-empty lines of a (filename, start, end) range from readSpans.
+    With limit, only the first limit lines of its first 64KB are read. '''
+    filename, start, end = span
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        if limit is None:
+            return _textLines(file.read(end - start).decode('utf-8'))
+        block = file.read(min(end - start, 1 << 16))
+        if start + len(block) < end:
+            block = block[:block.rfind(b"\n") + 1]
+        return _textLines(block.decode('utf-8'))[:limit]
+
+
+def parseLines(info, headers, lines, sep, idAlgorithm=None, schema=None, stats=None):
+    ''' Turn raw data lines into documents ready for the db writers.
+    With idAlgorithm set, a binary digest of the raw line and file name is
+    stored as _id instead of the md5 hex "hash" column. schema is a tuple of
+    column type specs (see healthandstatus.schema) applied column by column. '''
+    rows = [raw.split(sep) for raw in lines]
+    if idAlgorithm:
+        keys = [raw.encode('utf-8') for raw in lines]
+    else:
+        keys = rows
+    return _documents(info, headers, rows, keys, idAlgorithm, schema, stats)
+
+
+def parseSpan(info, headers, span, sep, idAlgorithm=None, schema=None, stats=None):
+    ''' Like parseLines, for a range from readSpans: the range is read and
+    split here, so a worker process does the I/O instead of its parent '''
+    return parseLines(info, headers, spanLines(span), sep, idAlgorithm, schema, stats)
+
+
+def parseTimed(parser, *args):
+    ''' Run a parser such as parseLines with hash timing turned on. Hashing is
+    timed once per chunk, so this costs two clock reads.
+    Returns (documents, {"parse": seconds, "hash": seconds}) as measured in the worker. '''
+    stats = {"hash": 0.0}
+    started = time.perf_counter()
+    documents = parser(*args, stats=stats)
+    stats["parse"] = time.perf_counter() - started
+    return documents, stats
+
+
+def parseEncoded(parser, *args):
+    ''' parseTimed for worker processes. Each document comes back as its BSON
+    bytes, which unpickle with a memcpy apiece instead of rebuilding a dict;
+    decodeDocuments wraps them for the writers to insert as they are. '''
+    documents, stats = parseTimed(parser, *args)
+    return list(map(bson.encode, documents)), stats
+
+
+def decodeDocuments(encoded):
+    ''' RawBSONDocuments over parseEncoded output; fields are only decoded if read '''
+    return list(map(RawBSONDocument, encoded))
+
+
+def _documents(info, headers, rows, keys, idAlgorithm, schema, stats=None):
+    ''' Build documents from split rows. keys holds what gets hashed per row:
+    the raw line bytes for _id digests, the split cells for the md5 hash.
+    Every row is hashed in one pass, and if stats is a dict the time that pass
+    took is added to stats["hash"]. '''
+    basename = info["basename"]
+    owner = info["owner"]
+    system = info["system"]
+    filedate = info["date"]
+    documents = []
+
+    if idAlgorithm:
+        hasher = createHasher(idAlgorithm)
+        # Canonical encoding: the raw line, a unit separator, then the file name
+        suffix = b"\x1f" + basename.encode('utf-8')
+
+    width = len(headers)
+
+    if schema:
+        # Convert a column at a time so each converter runs in one tight loop
+        columns = [[row[i].strip() for row in rows] for i in range(0,width)]
+        for i, convert in enumerate(compileSchema(schema)):
+            if convert is not None:
+                columns[i] = convertColumn(convert, columns[i])
+        cells = zip(*columns)
+    else:
+        cells = ([line[i].strip() for i in range(0,width)] for line in rows)
+
+    if stats is not None:
+        started = time.perf_counter()
+
+    if idAlgorithm:
+        # The digest is the primary key, so dedup needs no secondary index
+        field = "_id"
+        digests = [hasher(key + suffix) for key in keys]
+    else:
+        # hash line+filename
+        field = "hash"
+        digests = [hashlib.md5("{}_{}".format(key, basename).encode('utf-8')).hexdigest() for key in keys]
+
+    if stats is not None:
+        stats["hash"] += time.perf_counter() - started
+
+    for digest, values in zip(digests, cells):
+
+        data = dict(zip(headers, values))
+
+        # Add identifying information
+        data["owner"] = owner
+        data["system"] = system
+        data["date"] = filedate
+        data[field] = digest
+
+        documents.append(data)
+
+    return documents
+
+
+class ThreadParseBackend(object):
+    ''' Parse files directly in the calling thread '''
+
+    # Parsers get the lines the caller read, and return documents as they are
+    remote = False
+
+    def __init__(self, workers=3):
+        self.workers = workers
+
+    def start(self):
+        pass
+
+    def parse(self, func, *args):
+        return func(*args)
+
+    def shutdown(self):
+        pass
+
+
+class ProcessParseBackend(object):
+    ''' Parse files in a pool of worker processes so parsing is not bound by the GIL '''
+
+    # Workers read their own byte ranges (readSpans/parseSpan), so the
+    # parent does not read lines
+    remote = True
+
+    def __init__(self, workers=None, encode=True):
+        self.workers = workers or os.cpu_count() or 1
+        # Send documents back as BSON (parseEncoded) rather than pickled dicts
+        self.encode = encode
+        self.__pool = None
+
+    def start(self):
+        if self.__pool is None:
+            self.__pool = ProcessPoolExecutor(max_workers=self.workers)
+
+    def parse(self, func, *args):
+        # The calling thread blocks without holding the GIL while a worker
+        # process does the work
+        return self.__pool.submit(func, *args).result()
+
+    def shutdown(self):
+        if self.__pool is not None:
+            self.__pool.shutdown(wait=True)
+            self.__pool = None
+
+
+def createParseBackend(name, workers=None):
+    ''' Build a parse backend from its name ("thread" or "process") '''
+    if name == "thread":
+        return ThreadParseBackend(workers or 3)
+    if name == "process":
+        return ProcessParseBackend(workers)
+    raise Exception("Unknown parse backend: {0}".format(name))
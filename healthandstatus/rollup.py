@@ -0,0 +1,142 @@
+import numbers
+
+GRANULARITIES = ("minute", "hour", "day")
+
+# Every collection's summaries live here, keyed by the fields in ROLLUP_KEY
+ROLLUP_COLLECTION = "rollups"
+ROLLUP_KEY = ("collection", "granularity", "bucket", "owner", "system")
+
+# One document per file listing the row ranges already folded into the rollups
+ROLLUP_RANGES = "rollupRanges"
+
+
+def bucketStart(date, granularity):
+    ''' Truncate a datetime to the start of its minute, hour or day '''
+    if granularity == "minute":
+        return date.replace(second=0, microsecond=0)
+    if granularity == "hour":
+        return date.replace(minute=0, second=0, microsecond=0)
+    if granularity == "day":
+        return date.replace(hour=0, minute=0, second=0, microsecond=0)
+    raise Exception("Granularity must be one of {0}".format(", ".join(GRANULARITIES)))
+
+
+def _numeric(value):
+    # bool is an int subclass but summing flags is not what anyone wants
+    return isinstance(value, numbers.Real) and not isinstance(value, bool)
+
+
+def _fieldName(name):
+    # Keys that would turn into update paths or operators are left out
+    return isinstance(name, str) and name and "." not in name and not name.startswith("$")
+
+
+class RollupAccumulator(object):
+    ''' Summaries of one batch of documents, grouped by owner, system and time
+    bucket: a row count, the first and last sample time, and count/sum/min/max
+    for every numeric column. Only typed columns (see setSchema/setInferTypes)
+    hold numbers; plain string columns are counted in rows only. '''
+
+    def __init__(self, collection, granularities=("hour",)):
+        self.collection = collection
+        self.granularities = tuple(granularities)
+        self.groups = {}
+
+    def add(self, documents, skip=None):
+        ''' Fold documents in, leaving out the indexes in skip '''
+        skip = set(skip) if skip else None
+        for index, doc in enumerate(documents):
+            if skip is not None and index in skip:
+                continue
+            date = doc.get("date")
+            if date is None:
+                continue
+            for granularity in self.granularities:
+                key = (granularity, bucketStart(date, granularity), doc.get("owner"), doc.get("system"))
+                group = self.groups.get(key)
+                if group is None:
+                    group = self.groups[key] = {"count": 0, "first": date, "last": date, "fields": {}}
+                group["count"] += 1
+                if date < group["first"]:
+                    group["first"] = date
+                if date > group["last"]:
+                    group["last"] = date
+                fields = group["fields"]
+                for name, value in doc.items():
+                    if not _numeric(value) or not _fieldName(name):
+                        continue
+                    stats = fields.get(name)
+                    if stats is None:
+                        fields[name] = {"count": 1, "sum": value, "min": value, "max": value}
+                    else:
+                        stats["count"] += 1
+                        stats["sum"] += value
+                        if value < stats["min"]:
+                            stats["min"] = value
+                        if value > stats["max"]:
+                            stats["max"] = value
+        return self
+
+    def updates(self):
+        ''' (filter, update) pairs that merge this batch into the rollup collection '''
+        out = []
+        for (granularity, bucket, owner, system), group in self.groups.items():
+            query = {"collection": self.collection, "granularity": granularity, "bucket": bucket,
+                     "owner": owner, "system": system}
+            inc = {"count": group["count"]}
+            low = {"first": group["first"]}
+            high = {"last": group["last"]}
+            for name, stats in group["fields"].items():
+                path = "fields." + name
+                inc[path + ".count"] = stats["count"]
+                inc[path + ".sum"] = stats["sum"]
+                low[path + ".min"] = stats["min"]
+                high[path + ".max"] = stats["max"]
+            out.append((query, {"$inc": inc, "$min": low, "$max": high}))
+        return out
+
+
+def coveredRows(ranges, start, end):
+    ''' Row numbers in [start, end) that ranges say were already rolled up.
+    Each range is {"start", "end", "skipped"}; skipped rows failed to insert
+    and were left out at the time. '''
+    covered = set()
+    for r in ranges:
+        low, high = max(start, r["start"]), min(end, r["end"])
+        if low < high:
+            skipped = set(r.get("skipped") or ())
+            covered.update(i for i in range(low, high) if i not in skipped)
+    return covered
+
+
+def mergeRollups(rollups, groupBy=("owner", "system")):
+    ''' Combine rollup documents into one summary per groupBy value, adding a
+    mean for each numeric field. An empty groupBy gives a single summary. '''
+    groups = {}
+    for doc in rollups:
+        key = tuple(doc.get(k) for k in groupBy)
+        summary = groups.get(key)
+        if summary is None:
+            summary = dict((k, doc.get(k)) for k in groupBy)
+            summary.update({"count": 0, "buckets": 0, "first": doc.get("first"), "last": doc.get("last"), "fields": {}})
+            groups[key] = summary
+        summary["count"] += doc.get("count", 0)
+        summary["buckets"] += 1
+        if doc.get("first") is not None and (summary["first"] is None or doc["first"] < summary["first"]):
+            summary["first"] = doc["first"]
+        if doc.get("last") is not None and (summary["last"] is None or doc["last"] > summary["last"]):
+            summary["last"] = doc["last"]
+        for name, stats in (doc.get("fields") or {}).items():
+            merged = summary["fields"].get(name)
+            if merged is None:
+                summary["fields"][name] = dict(stats)
+                continue
+            merged["count"] += stats["count"]
+            merged["sum"] += stats["sum"]
+            merged["min"] = min(merged["min"], stats["min"])
+            merged["max"] = max(merged["max"], stats["max"])
+
+    for summary in groups.values():
+        for stats in summary["fields"].values():
+            stats["mean"] = stats["sum"] / stats["count"] if stats["count"] else None
+    return [groups[key] for key in sorted(groups, key=lambda k: tuple(str(v) for v in k))]
@@ -0,0 +1,110 @@
+import hashlib
+import zlib
+
+from .rollup import ROLLUP_COLLECTION, ROLLUP_RANGES
+
+# Bookkeeping collections stay on the first node regardless of policy
+METADATA_COLLECTIONS = ("ingestedFiles", ROLLUP_COLLECTION, ROLLUP_RANGES)
+
+
+class SingleNodePolicy(object):
+    ''' Everything goes to node 0 '''
+
+    def bind(self, nodes):
+        self.nodes = nodes
+
+    def nodesFor(self, collection):
+        return [0]
+
+    def nodeFor(self, collection, document):
+        return 0
+
+
+class CollectionRoutingPolicy(object):
+    ''' Each collection lives on exactly one node. Collections in mapping go
+    where they are told; the rest are spread by a stable hash of their name. '''
+
+    def __init__(self, mapping=None):
+        self.mapping = dict(mapping or {})
+        self.nodes = 1
+
+    def bind(self, nodes):
+        for collection, node in self.mapping.items():
+            if not 0 <= node < nodes:
+                raise Exception("Collection {0} routed to missing node {1}".format(collection, node))
+        self.nodes = nodes
+
+    def __node(self, collection):
+        if collection in self.mapping:
+            return self.mapping[collection]
+        if collection in METADATA_COLLECTIONS:
+            return 0
+        return zlib.crc32(collection.encode('utf-8')) % self.nodes
+
+    def nodesFor(self, collection):
+        return [self.__node(collection)]
+
+    def nodeFor(self, collection, document):
+        return self.__node(collection)
+
+
+class HashRangeRoutingPolicy(object):
+    ''' Split a collection across every node by ranges of the row digest.
+    The digest is taken from field, or from _id and then "hash" when field
+    is None, so it works with both the md5 hash column and digest _ids.
+    Collections outside collections (if given) stay on node 0. '''
+
+    def __init__(self, collections=None, field=None):
+        self.collections = set(collections) if collections else None
+        self.field = field
+        self.nodes = 1
+
+    def bind(self, nodes):
+        self.nodes = nodes
+
+    def __sharded(self, collection):
+        if collection in METADATA_COLLECTIONS:
+            return False
+        return self.collections is None or collection in self.collections
+
+    def nodesFor(self, collection):
+        if self.__sharded(collection):
+            return list(range(self.nodes))
+        return [0]
+
+    def nodeFor(self, collection, document):
+        if not self.__sharded(collection):
+            return 0
+        key = document.get(self.field) if self.field else document.get("_id", document.get("hash"))
+        if isinstance(key, bytes):
+            digest = key
+        elif isinstance(key, str) and len(key) == 32:
+            try:
+                digest = bytes.fromhex(key)
+            except ValueError:
+                digest = hashlib.md5(key.encode('utf-8')).digest()
+        else:
+            digest = hashlib.md5(repr(key).encode('utf-8')).digest()
+        # Top 64 bits of the digest pick a contiguous range of the keyspace
+        return (int.from_bytes(digest[:8].rjust(8, b'\0'), 'big') * self.nodes) >> 64
+
+
+def availableCompressors(preferred=("zstd", "snappy", "zlib")):
+    ''' Wire compressors from preferred whose Python packages are installed.
+    zlib is always available. '''
+    available = []
+    for name in preferred:
+        if name == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                continue
+        elif name == "snappy":
+            try:
+                import snappy
+            except ImportError:
+                continue
+        elif name != "zlib":
+            raise Exception("Unknown compressor: {0}".format(name))
+        available.append(name)
+    return available
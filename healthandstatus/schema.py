@@ -0,0 +1,138 @@
+import datetime
+import functools
+import threading
+
+TYPES = ("str", "int", "float", "bool", "datetime")
+
+# Tried in order when inferring datetime columns
+DATETIME_FORMATS = (
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S",
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y.%m.%d.%H.%M.%S",
+    "%m/%d/%Y %H:%M:%S",
+    "%Y-%m-%d",
+)
+
+BOOLEANS = {"true": True, "false": False}
+
+
+def toBool(value):
+    return BOOLEANS[value.lower()]
+
+
+def converter(spec):
+    ''' Converter function for a type spec such as "int" or "datetime:%Y-%m-%d" '''
+    if spec == "int":
+        return int
+    if spec == "float":
+        return float
+    if spec == "bool":
+        return toBool
+    if spec.startswith("datetime"):
+        fmt = spec.partition(":")[2] or DATETIME_FORMATS[0]
+        return lambda value: datetime.datetime.strptime(value, fmt)
+    if spec == "str":
+        return None
+    raise Exception("Unknown column type: {0}".format(spec))
+
+
+@functools.lru_cache(maxsize=256)
+def compileSchema(schema):
+    ''' Turn a tuple of type specs into a tuple of converters (None = keep string).
+    Cached so each header layout is compiled once per process. '''
+    return tuple(converter(spec) for spec in schema)
+
+
+def convertColumn(convert, values):
+    ''' Convert a whole column at once. Empty cells become None. An int
+    column widens to float for cells such as "2.5", so numeric columns stay
+    numeric for range queries; other cells that don't fit are kept as strings. '''
+    try:
+        return [convert(v) if v else None for v in values]
+    except (ValueError, KeyError):
+        pass
+    converters = (convert, float) if convert is int else (convert,)
+    converted = []
+    for v in values:
+        if not v:
+            converted.append(None)
+            continue
+        for attempt in converters:
+            try:
+                converted.append(attempt(v))
+                break
+            except (ValueError, KeyError):
+                pass
+        else:
+            converted.append(v)
+    return converted
+
+
+def inferType(values):
+    ''' Narrowest type spec that every non-empty sample value fits '''
+    values = [v for v in values if v]
+    if not values:
+        return "str"
+    for spec in ("int", "float", "bool"):
+        convert = converter(spec)
+        try:
+            for v in values:
+                convert(v)
+            return spec
+        except (ValueError, KeyError):
+            pass
+    for fmt in DATETIME_FORMATS:
+        try:
+            for v in values:
+                datetime.datetime.strptime(v, fmt)
+            return "datetime:" + fmt
+        except ValueError:
+            pass
+    return "str"
+
+
+class SchemaRegistry(object):
+    ''' Column types per collection and header layout.
+    Explicit types win; other columns are inferred from the first sample
+    seen for a layout and then reused for every later file with it. '''
+
+    def __init__(self, infer=False):
+        self.infer = infer
+        self.__explicit = {}
+        self.__resolved = {}
+        self.__lock = threading.Lock()
+
+    def setSchema(self, collection, types):
+        for column, spec in types.items():
+            converter(spec)  # validate
+        with self.__lock:
+            self.__explicit[collection] = dict(types)
+            for key in [k for k in self.__resolved if k[0] == collection]:
+                del self.__resolved[key]
+
+    def resolve(self, collection, headers, lines, sep, sample=100):
+        ''' Tuple of type specs aligned with headers, or None if nothing is typed.
+        lines may be a function returning them, called only if the layout is new. '''
+        key = (collection, tuple(headers))
+        with self.__lock:
+            if key in self.__resolved:
+                return self.__resolved[key]
+
+            if callable(lines):
+                lines = lines()
+            explicit = self.__explicit.get(collection, {})
+            rows = [line.split(sep) for line in lines[:sample]]
+            schema = []
+            for i, header in enumerate(headers):
+                if header in explicit:
+                    schema.append(explicit[header])
+                elif self.infer:
+                    schema.append(inferType([row[i].strip() for row in rows if i < len(row)]))
+                else:
+                    schema.append("str")
+
+            schema = tuple(schema) if any(spec != "str" for spec in schema) else None
+            self.__resolved[key] = schema
+            return schema
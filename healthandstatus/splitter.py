@@ -0,0 +1,227 @@
+''' Build .dat corpora for ingestion.
+
+splitFile cuts a large CSV into owner_collection_system_DTG.dat chunks;
+generateTree writes a synthetic tree of them. Both are meant to be bounded
+by disk speed:
+
+    python -m healthandstatus.splitter split /tmp/5milrecords.csv /tmp/files --rows-per-file 500 --workers 4
+    python -m healthandstatus.splitter generate /tmp/files --files 1000 --rows 5000 --workers 4
+'''
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+import argparse
+import datetime
+import itertools
+import os
+import random
+
+DTG_FORMAT = "%Y.%m.%d.%H.%M.%S"
+
+
+def chunkName(owner, collection, system, date):
+    ''' owner_collection_system_DTG.dat for date '''
+    return "{0}_{1}_{2}_{3}.dat".format(owner, collection, system, date.strftime(DTG_FORMAT))
+
+
+def dtgSequence(start=None, step=1):
+    ''' Yield start, start + step seconds, ... DTGs only resolve to the second,
+    so step must be a whole number of seconds for the names to stay unique. '''
+    if not isinstance(step, int) or step < 1:
+        raise Exception("Step must be a positive whole number of seconds")
+    date = (start or datetime.datetime.utcnow()).replace(microsecond=0)
+    delta = datetime.timedelta(seconds=step)
+    while True:
+        yield date
+        date += delta
+
+
+def newestDate(dest, owner, collection, system):
+    ''' Latest DTG among owner_collection_system_DTG.dat files in dest, or None '''
+    prefix = "{0}_{1}_{2}_".format(owner, collection, system)
+    newest = None
+    try:
+        names = os.listdir(dest)
+    except FileNotFoundError:
+        return None
+    for name in names:
+        if not (name.startswith(prefix) and name.endswith(".dat")):
+            continue
+        try:
+            date = datetime.datetime.strptime(name[len(prefix):-len(".dat")], DTG_FORMAT)
+        except ValueError:
+            continue
+        if newest is None or date > newest:
+            newest = date
+    return newest
+
+
+def _checkParts(*parts):
+    for part in parts:
+        if not part or "_" in part:
+            raise Exception("Owner, collection and system must be non-empty and contain no '_': {0}".format(part))
+
+
+def writeChunk(path, header, lines, bufferSize=1 << 20, exclusive=True):
+    ''' Write header and lines (bytes) to a file in one buffered pass. When
+    exclusive, fails rather than overwriting a file that already exists. '''
+    with open(path, 'xb' if exclusive else 'wb', buffering=bufferSize) as file:
+        file.write(header)
+        file.writelines(lines)
+    return path
+
+
+class _Writer(object):
+    # Runs writes inline, or on a thread pool with at most 2 * workers chunks
+    # held in memory at once
+
+    def __init__(self, workers):
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="splitter") if workers > 1 else None
+        self.__pending = deque()
+        self.__limit = 2 * workers
+
+    def submit(self, func, *args):
+        if self.__pool is None:
+            func(*args)
+            return
+        while len(self.__pending) >= self.__limit:
+            self.__pending.popleft().result()
+        self.__pending.append(self.__pool.submit(func, *args))
+
+    def close(self):
+        try:
+            while self.__pending:
+                self.__pending.popleft().result()
+        finally:
+            if self.__pool is not None:
+                self.__pool.shutdown(wait=True)
+
+
+def splitFile(src, dest, owner="ABC-123", collection="Hyperic", system="system1", rowsPerFile=500,
+              start=None, step=1, workers=1, bufferSize=1 << 20):
+    ''' Split a CSV whose first line is the header into chunks of rowsPerFile
+    data rows under dest, each starting with the header. Chunk i is dated
+    start + i * step seconds. Returns the chunk paths in order.
+    With no start, the first chunk is dated now or just after the newest
+    chunk of the same owner, collection and system already in dest, so
+    splitting into the same dest again adds files instead of clashing. An
+    explicit start at or before an existing chunk is refused up front. '''
+    _checkParts(owner, collection, system)
+    if not isinstance(rowsPerFile, int) or rowsPerFile < 1:
+        raise Exception("Rows per file must be a positive integer")
+
+    newest = newestDate(dest, owner, collection, system)
+    if start is None:
+        start = datetime.datetime.utcnow().replace(microsecond=0)
+        if newest is not None and newest >= start:
+            start = newest + datetime.timedelta(seconds=1)
+    elif newest is not None and newest >= start.replace(microsecond=0):
+        raise Exception("{0} already has chunks dated up to {1}; start after it".format(
+            dest, newest.strftime(DTG_FORMAT)))
+    os.makedirs(dest, exist_ok=True)
+
+    dates = dtgSequence(start, step)
+    writer = _Writer(workers)
+    paths = []
+
+    try:
+        # Bytes all the way through; nothing is decoded or re-encoded
+        with open(src, 'rb', buffering=bufferSize) as infile:
+            header = infile.readline()
+            if not header:
+                return paths
+            if not header.endswith(b"\n"):
+                header += b"\n"
+
+            while True:
+                lines = list(itertools.islice(infile, rowsPerFile))
+                if not lines:
+                    break
+                if not lines[-1].endswith(b"\n"):
+                    lines[-1] += b"\n"
+                path = os.path.join(dest, chunkName(owner, collection, system, next(dates)))
+                writer.submit(writeChunk, path, header, lines, bufferSize)
+                paths.append(path)
+    finally:
+        writer.close()
+
+    return paths
+
+
+def _generateFile(path, headers, rows, columns, seed, bufferSize):
+    rng = random.Random(seed)
+    rand = rng.random
+    row = "%d" + ",%.3f" * (columns - 1) + "\n"
+    lines = [(row % ((r,) + tuple(rand() * 100 for c in range(columns - 1)))).encode('ascii') for r in range(rows)]
+    # Same seed, same content, so regenerating over an old tree is harmless
+    writeChunk(path, headers, lines, bufferSize, exclusive=False)
+    return rows
+
+
+def generateTree(root, files=100, rows=1000, columns=5, owners=2, collections=1, systems=4, dirs=4, seed=0,
+                 start=datetime.datetime(2021, 3, 30), workers=1, bufferSize=1 << 20):
+    ''' Write a synthetic H&S tree under root. Each file is seeded on its own,
+    so the output is the same however many workers build it. Rows are
+    formatted in worker processes when workers > 1. Returns the number of
+    data rows written. '''
+    headers = (",".join(["#Tablename"] + ["metric{0}".format(c) for c in range(columns)]) + "\n").encode('ascii')
+    dates = dtgSequence(start)
+    jobs = []
+
+    for i in range(files):
+        directory = os.path.join(root, "dir{0}".format(i % dirs))
+        os.makedirs(directory, exist_ok=True)
+        name = chunkName("owner{0}".format(i % owners), "collection{0}".format(i % collections),
+                         "system{0}".format(i % systems), next(dates))
+        jobs.append((os.path.join(directory, name), headers, rows, columns, seed * 1000003 + i, bufferSize))
+
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(_generateFile, *job) for job in jobs]
+            return sum(future.result() for future in futures)
+    return sum(_generateFile(*job) for job in jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build H&S .dat corpora")
+    commands = parser.add_subparsers(dest="command")
+    commands.required = True
+
+    split = commands.add_parser("split", help="split a CSV into .dat chunks")
+    split.add_argument("src")
+    split.add_argument("dest")
+    split.add_argument("--owner", default="ABC-123")
+    split.add_argument("--collection", default="Hyperic")
+    split.add_argument("--system", default="system1")
+    split.add_argument("--rows-per-file", type=int, default=500)
+    split.add_argument("--start", default=None,
+                       help="DTG of the first chunk, e.g. 2021.03.30.00.00.00 (default now, or after the newest chunk in dest)")
+    split.add_argument("--step", type=int, default=1, help="seconds between chunk DTGs")
+    split.add_argument("--workers", type=int, default=1)
+
+    generate = commands.add_parser("generate", help="write a synthetic tree")
+    generate.add_argument("root")
+    generate.add_argument("--files", type=int, default=100)
+    generate.add_argument("--rows", type=int, default=1000, help="data rows per file")
+    generate.add_argument("--columns", type=int, default=5)
+    generate.add_argument("--owners", type=int, default=2)
+    generate.add_argument("--collections", type=int, default=1)
+    generate.add_argument("--systems", type=int, default=4)
+    generate.add_argument("--dirs", type=int, default=4)
+    generate.add_argument("--seed", type=int, default=0)
+    generate.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.command == "split":
+        start = datetime.datetime.strptime(args.start, DTG_FORMAT) if args.start else None
+        paths = splitFile(args.src, args.dest, owner=args.owner, collection=args.collection, system=args.system,
+                          rowsPerFile=args.rows_per_file, start=start, step=args.step, workers=args.workers)
+        print("Wrote {0} files to {1}".format(len(paths), args.dest))
+    else:
+        rows = generateTree(args.root, files=args.files, rows=args.rows, columns=args.columns, owners=args.owners,
+                            collections=args.collections, systems=args.systems, dirs=args.dirs, seed=args.seed,
+                            workers=args.workers)
+        print("Wrote {0} rows in {1} files to {2}".format(rows, args.files, args.root))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+from pymongo import InsertOne, errors
+import bson
+import random
+import threading
+import time
+
+# Errors worth retrying: network blips, elections, server selection timeouts
+TRANSIENT_ERRORS = (errors.AutoReconnect, errors.NetworkTimeout, errors.ExecutionTimeout)
+
+DUPLICATE_KEY = 11000
+
+# Leave headroom under the 48MB maximum message size
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+
+class AdaptiveBatcher(object):
+    ''' Splits documents into batches bounded by count and bytes. The count
+    grows while batches land under targetLatency and halves when they don't. '''
+
+    def __init__(self, initialDocs=1000, minDocs=100, maxDocs=50000, maxBytes=MAX_BATCH_BYTES, targetLatency=0.5):
+        if not 0 < minDocs <= initialDocs <= maxDocs:
+            raise Exception("Batch sizes must satisfy 0 < minDocs <= initialDocs <= maxDocs")
+        self.minDocs = minDocs
+        self.maxDocs = maxDocs
+        self.maxBytes = maxBytes
+        self.targetLatency = targetLatency
+        self.size = initialDocs
+        self.__lock = threading.Lock()
+
+    def batches(self, documents, sample=10):
+        ''' Yield slices of documents sized for the current target '''
+        if not documents:
+            return
+        # Estimate document size from a small sample rather than encoding everything
+        sampled = documents[:sample]
+        avgBytes = max(1, sum(len(bson.encode(d)) for d in sampled) // len(sampled))
+
+        start = 0
+        while start < len(documents):
+            count = max(1, min(self.size, self.maxBytes // avgBytes))
+            yield documents[start:start + count]
+            start += count
+
+    def observe(self, count, seconds):
+        ''' Feed back how long a batch of count documents took to write '''
+        with self.__lock:
+            if count < self.size:
+                # Short tail batches say nothing about the limit
+                return
+            if seconds > self.targetLatency:
+                self.size = max(self.minDocs, self.size // 2)
+            else:
+                self.size = min(self.maxDocs, int(self.size * 1.25) + 1)
+
+
+class BulkWriter(object):
+    ''' Inserts documents with bulk_write, retrying transient errors with
+    exponential backoff and accounting for every row. '''
+
+    def __init__(self, writeConcern=None, batcher=None, retries=5, backoff=0.1, maxBackoff=5.0, ordered=False,
+                 bypassValidation=True):
+        self.writeConcern = writeConcern
+        self.batcher = batcher or AdaptiveBatcher()
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.ordered = ordered
+        self.bypassValidation = bypassValidation
+        # Optional healthandstatus.metrics.Metrics, set by the driver
+        self.metrics = None
+
+    def write(self, collection, documents, rejected=None):
+        ''' Insert documents into a pymongo collection.
+        Returns counts of inserted, duplicate and failed rows. If rejected is a
+        dict, it maps the index of every document that was not inserted to
+        "duplicate" or "failed". Rows that landed before a retried error come
+        back as duplicates.
+        Errors are not raised: if the connection is lost or retries run out,
+        the batches not yet written count as failed and the error is returned
+        in result["error"] for the caller to act on. '''
+        if self.writeConcern is not None:
+            collection = collection.with_options(write_concern=self.writeConcern)
+
+        result = {"inserted": 0, "duplicates": 0, "failed": 0, "batches": 0, "retries": 0, "error": None}
+
+        offset = 0
+        for batch in self.batcher.batches(documents):
+            try:
+                counts = self.__writeBatch(collection, batch, rejected, offset)
+            except errors.PyMongoError as e:
+                # Give up on this batch and the rest, keeping what already landed
+                result["failed"] += len(documents) - offset
+                if rejected is not None:
+                    rejected.update((i, "failed") for i in range(offset, len(documents)))
+                result["error"] = e
+                break
+            for key, value in counts.items():
+                result[key] += value
+            result["batches"] += 1
+            offset += len(batch)
+
+        return result
+
+    def __writeBatch(self, collection, batch, rejected=None, offset=0):
+        counts = {"inserted": 0, "duplicates": 0, "failed": 0, "retries": 0}
+        attempt = 0
+
+        while True:
+            started = time.time()
+            try:
+                res = collection.bulk_write([InsertOne(d) for d in batch], ordered=self.ordered,
+                                            bypass_document_validation=self.bypassValidation)
+                counts["inserted"] += res.inserted_count
+                self.__observe(collection, batch, started)
+                return counts
+            except errors.BulkWriteError as e:
+                details = e.details
+                if details.get("writeConcernErrors"):
+                    # The rows reached the primary but the write concern wasn't
+                    # met (e.g. a majority wtimeout), so none count as written
+                    print("Write concern not satisfied: {0}".format(details["writeConcernErrors"][0].get("errmsg")))
+                    counts["failed"] += details.get("nInserted", 0)
+                    if self.metrics is not None:
+                        self.metrics.inc("write_concern_errors", collection=collection.name)
+                else:
+                    counts["inserted"] += details.get("nInserted", 0)
+                for error in details.get("writeErrors", []):
+                    if error.get("code") == DUPLICATE_KEY:
+                        counts["duplicates"] += 1
+                    else:
+                        counts["failed"] += 1
+                if self.ordered:
+                    # An ordered batch stops at the first error; the rest were never tried
+                    counts["failed"] += len(batch) - details.get("nInserted", 0) - len(details.get("writeErrors", []))
+                if rejected is not None:
+                    reasons = {}
+                    for error in details.get("writeErrors", []):
+                        if "index" in error:
+                            reasons[error["index"]] = "duplicate" if error.get("code") == DUPLICATE_KEY else "failed"
+                    if details.get("writeConcernErrors"):
+                        untried = range(len(batch))
+                    elif self.ordered and reasons:
+                        untried = range(min(reasons), len(batch))
+                    else:
+                        untried = ()
+                    for i in untried:
+                        reasons.setdefault(i, "failed")
+                    rejected.update((offset + i, reason) for i, reason in reasons.items())
+                self.__observe(collection, batch, started)
+                return counts
+            except TRANSIENT_ERRORS:
+                if attempt >= self.retries:
+                    raise
+                # Rows that landed before the error come back as duplicates on retry
+                delay = min(self.maxBackoff, self.backoff * (2 ** attempt))
+                time.sleep(delay * (0.5 + random.random() / 2))
+                attempt += 1
+                counts["retries"] += 1
+                if self.metrics is not None:
+                    self.metrics.inc("insert_retries", collection=collection.name)
+            except errors.ConnectionFailure:
+                raise
+            except errors.PyMongoError as e:
+                print(str(e))
+                counts["failed"] += len(batch)
+                if rejected is not None:
+                    rejected.update((i, "failed") for i in range(offset, offset + len(batch)))
+                return counts
+
+    def __observe(self, collection, batch, started):
+        seconds = time.time() - started
+        self.batcher.observe(len(batch), seconds)
+        if self.metrics is not None:
+            self.metrics.observe("insert_batch_seconds", seconds, collection=collection.name)
+            self.metrics.inc("insert_batches", collection=collection.name)
+            self.metrics.inc("insert_documents", len(batch), collection=collection.name)
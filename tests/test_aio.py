@@ -0,0 +1,51 @@
+import asyncio
+
+from healthandstatus.aio import AsyncCustomMongodbDriver
+from healthandstatus.benchmark import FakeClient
+
+
+def test_iter_read_fetches_every_document_once():
+    async def scenario():
+        db = AsyncCustomMongodbDriver(client=FakeClient(), concurrency=4)
+        db.setDatabase("HealthAndStatusTest")
+        await db.create("c", [{"v": i} for i in range(300)])
+        docs = await asyncio.wait_for(db.iterRead("c", {}, sort=[("v", 1)], batchSize=13).toList(), 5)
+        db.close()
+        return [d["v"] for d in docs]
+
+    assert asyncio.run(scenario()) == list(range(300))
+
+
+def test_pipeline_matches_the_threaded_processor(tmp_path):
+    from healthandstatus.aio import AsyncIngestPipeline
+    from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+    from healthandstatus.splitter import generateTree
+
+    generateTree(str(tmp_path), files=6, rows=40, columns=3)
+
+    def configure(pipeline):
+        pipeline.setIgnoreFirstHeader(True)
+        pipeline.setInferTypes(True)
+        pipeline.setReader("mmap")
+        pipeline.setDigestId(True)
+
+    async def ingestAsync():
+        db = AsyncCustomMongodbDriver(client=FakeClient())
+        db.setDatabase("HealthAndStatusTest")
+        pipeline = AsyncIngestPipeline(db, chunkSize=15, files=2)
+        configure(pipeline)
+        results = await pipeline.run(src=str(tmp_path), traits=[".dat"])
+        db.close()
+        return results, db.sync.read("collection0", {}, sort=[("_id", 1)])
+
+    results, docs = asyncio.run(ingestAsync())
+    assert results["inserted"] == 240
+
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    processor = CustomMongodbFileProcessor(driver=db)
+    processor.setProgress(False)
+    processor.setChunkSize(15)
+    configure(processor)
+    processor.start(src=str(tmp_path), splitchar="_", sep=",", traits=[".dat"])
+    assert db.read("collection0", {}, sort=[("_id", 1)]) == docs
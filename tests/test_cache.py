@@ -0,0 +1,58 @@
+import threading
+
+from healthandstatus.benchmark import FakeClient, FakeCollection
+from healthandstatus.mongodb import CustomMongodbDriver
+
+
+def createDriver():
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    db.enableCache()
+    return db
+
+
+def test_read_is_cached_until_write():
+    db = createDriver()
+    db.create("c", [{"a": 1}])
+    assert db.read("c", {}) == [{"a": 1}]
+    assert db.read("c", {}) == [{"a": 1}]
+    assert db.cacheStats()["hits"] == 1
+
+    db.create("c", [{"a": 2}])
+    assert sorted(d["a"] for d in db.read("c", {})) == [1, 2]
+
+
+def test_read_during_write_is_not_cached(monkeypatch):
+    db = createDriver()
+    db.create("c", [{"a": 1}])
+    assert db.read("c", {}) == [{"a": 1}]
+
+    original = FakeCollection.bulk_write
+    entered = threading.Event()
+    release = threading.Event()
+
+    def heldWrite(self, *args, **kwargs):
+        entered.set()
+        release.wait(5)
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(FakeCollection, "bulk_write", heldWrite)
+    writer = threading.Thread(target=db.bulkCreate, kwargs={"collection": "c", "data": [{"a": 2}]})
+    writer.start()
+    assert entered.wait(5)
+    # Starts after the pre-write invalidation, finishes before the row lands
+    assert db.read("c", {}) == [{"a": 1}]
+    release.set()
+    writer.join()
+
+    assert sorted(d["a"] for d in db.read("c", {})) == [1, 2]
+
+
+def test_update_and_delete_invalidate():
+    db = createDriver()
+    db.create("c", [{"a": 1}, {"a": 2}])
+    assert len(db.read("c", {"a": 1})) == 1
+    db.update("c", {"a": 1}, {"b": True})
+    assert db.read("c", {"a": 1}) == [{"a": 1, "b": True}]
+    db.delete("c", {"a": 1})
+    assert db.read("c", {"a": 1}) == []
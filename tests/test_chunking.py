@@ -0,0 +1,71 @@
+import threading
+
+from pymongo import errors
+
+from healthandstatus.benchmark import FakeClient, FakeCollection
+from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+
+GOOD = "owner_collection_system_2021.03.30.00.00.00.dat"
+
+
+def ingest(tmp_path, rows=35):
+    with open(str(tmp_path / GOOD), 'w') as file:
+        file.write("#Tablename,a,b\n")
+        for r in range(rows):
+            file.write("{0},{1}\n".format(r, r * 2))
+
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    # Rows in the collection each time the file is marked ingested
+    marked = []
+    update = db.update
+
+    def recordingUpdate(collection=None, data=None, changes=None, upsert=False):
+        if collection == "ingestedFiles":
+            marked.append(len(db.read("collection", {})))
+        return update(collection=collection, data=data, changes=changes, upsert=upsert)
+
+    db.update = recordingUpdate
+    processor = CustomMongodbFileProcessor(driver=db)
+    processor.setIgnoreFirstHeader(True)
+    processor.setProgress(False)
+    processor.setChunkSize(10)
+    processor.setQueueDepth(1)
+    processor.start(src=str(tmp_path), splitchar="_", sep=",", traits=[".dat"])
+    return processor, marked
+
+
+def test_marker_is_written_after_the_last_chunk(tmp_path, monkeypatch):
+    original = FakeCollection.bulk_write
+    chunks = []
+    lock = threading.Lock()
+
+    def countingWrite(self, requests, *args, **kwargs):
+        if self.name == "collection":
+            with lock:
+                chunks.append(len(requests))
+        return original(self, requests, *args, **kwargs)
+
+    monkeypatch.setattr(FakeCollection, "bulk_write", countingWrite)
+    processor, marked = ingest(tmp_path)
+    assert sorted(chunks) == [5, 10, 10, 10]
+    assert marked == [35]
+    assert processor.getResults()["inserted"] == 35
+
+
+def test_failed_chunk_leaves_the_file_unmarked(tmp_path, monkeypatch):
+    original = FakeCollection.bulk_write
+    calls = []
+
+    def failSecondChunk(self, requests, *args, **kwargs):
+        if self.name == "collection":
+            calls.append(len(requests))
+            if len(calls) == 2:
+                raise errors.OperationFailure("disk full")
+        return original(self, requests, *args, **kwargs)
+
+    monkeypatch.setattr(FakeCollection, "bulk_write", failSecondChunk)
+    processor, marked = ingest(tmp_path)
+    assert marked == []
+    results = processor.getResults()
+    assert (results["inserted"], results["failed"]) == (25, 10)
@@ -0,0 +1,107 @@
+import os
+
+import pytest
+
+from healthandstatus.benchmark import FakeClient
+from healthandstatus.manifest import manifestEntry, scanTree
+from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+
+GOOD = "owner_collection_system_2021.03.30.00.00.00.dat"
+
+
+def writeFile(path, text):
+    with open(path, 'w') as file:
+        file.write(text)
+
+
+def recorded(*paths, **extra):
+    ''' A lookup that knows paths as they are now '''
+    entries = {}
+    for path in paths:
+        entries[path] = manifestEntry(path, os.stat(path), **extra)
+    return lambda filenames: dict((f, entries[f]) for f in filenames if f in entries)
+
+
+def scanned(src, **kwargs):
+    return [entry["filename"] for entry in scanTree(src, [".dat"], **kwargs)]
+
+
+def test_new_and_changed_files_are_yielded(tmp_path):
+    same, grown, touched, new = (str(tmp_path / name) for name in ("same.dat", "grown.dat", "touched.dat", "new.dat"))
+    for path in (same, grown, touched):
+        writeFile(path, "#T,a\n1,2\n")
+    os.makedirs(str(tmp_path / "sub"))
+    nested = str(tmp_path / "sub" / "nested.dat")
+    writeFile(nested, "#T,a\n1,2\n")
+    writeFile(str(tmp_path / "ignored.txt"), "#T,a\n")
+    lookup = recorded(same, grown, touched, nested)
+
+    writeFile(grown, "#T,a\n1,2\n3,4\n")
+    stat = os.stat(touched)
+    os.utime(touched, (stat.st_atime, stat.st_mtime + 10))
+    writeFile(new, "#T,a\n1,2\n")
+
+    assert sorted(scanned(str(tmp_path), lookup=lookup)) == sorted([grown, touched, new])
+
+
+def test_legacy_entries_count_as_unchanged(tmp_path):
+    path = str(tmp_path / "old.dat")
+    writeFile(path, "#T,a\n1,2\n")
+    assert scanned(str(tmp_path), lookup=lambda filenames: {path: {"filename": path}}) == []
+
+
+def test_touched_file_with_the_same_digest_is_refreshed(tmp_path):
+    touched, rewritten = str(tmp_path / "touched.dat"), str(tmp_path / "rewritten.dat")
+    writeFile(touched, "#T,a\n1,2\n")
+    writeFile(rewritten, "#T,a\n1,2\n")
+    lookup = recorded(touched, rewritten, digest=True)
+    for path in (touched, rewritten):
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+    # Same size, different content
+    writeFile(rewritten, "#T,a\n3,4\n")
+
+    refreshed = []
+    entries = list(scanTree(str(tmp_path), [".dat"], lookup=lookup, digest=True, refresh=refreshed.append))
+    assert [e["filename"] for e in entries] == [rewritten]
+    assert entries[0]["digest"] != lookup([rewritten])[rewritten]["digest"]
+    assert [e["filename"] for e in refreshed] == [touched]
+    assert refreshed[0]["mtime"] == os.stat(touched).st_mtime
+
+
+def test_cache_skips_the_lookup(tmp_path):
+    path = str(tmp_path / "known.dat")
+    writeFile(path, "#T,a\n1,2\n")
+    cache = {}
+    assert scanned(str(tmp_path), lookup=recorded(path), cache=cache) == []
+    assert cache == {path: (os.stat(path).st_size, os.stat(path).st_mtime)}
+
+    def unexpected(filenames):
+        raise AssertionError("looked up {0}".format(filenames))
+
+    assert scanned(str(tmp_path), lookup=unexpected, cache=cache) == []
+
+
+def test_rerun_ingests_only_changed_files(tmp_path):
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    good = str(tmp_path / GOOD)
+    writeFile(good, "#Tablename,a,b\n0,1\n1,2\n")
+
+    def run():
+        processor = CustomMongodbFileProcessor(driver=db)
+        processor.setIgnoreFirstHeader(True)
+        processor.setProgress(False)
+        processor.start(src=str(tmp_path), splitchar="_", sep=",", traits=[".dat"])
+        return processor.getResults()
+
+    assert run()["inserted"] == 2
+    with pytest.raises(SystemExit):
+        run()
+
+    with open(good, 'a') as file:
+        file.write("2,3\n")
+    result = run()
+    assert (result["inserted"], result["duplicates"]) == (1, 2)
+    entry = db.read("ingestedFiles", {"filename": good})[0]
+    assert entry["size"] == os.path.getsize(good)
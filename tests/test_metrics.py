@@ -0,0 +1,54 @@
+import cProfile
+import json
+import os
+
+from healthandstatus.benchmark import FakeClient
+from healthandstatus.metrics import ThreadProfiler
+from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+from healthandstatus.splitter import generateTree
+
+
+def ingest(root, profiles):
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    processor = CustomMongodbFileProcessor(driver=db)
+    processor.setIgnoreFirstHeader(True)
+    processor.setProgress(False)
+    processor.setChunkSize(25)
+    processor.setProfiling(profiles)
+    processor.start(src=root, splitchar="_", sep=",", traits=[".dat"])
+    return processor
+
+
+def counter(processor, name):
+    counters = json.loads(processor.exportMetrics())["healthandstatus_ingest"]["counters"]
+    return sum(c["value"] for c in counters if c["name"] == name)
+
+
+def test_profiler_that_cannot_start_does_not_fail_the_work(tmp_path, monkeypatch):
+    generateTree(str(tmp_path / "files"), files=6, rows=50, columns=3)
+
+    def busy(self):
+        raise ValueError("Another profiling tool is already active")
+
+    monkeypatch.setattr(cProfile.Profile, "enable", busy)
+    processor = ingest(str(tmp_path / "files"), str(tmp_path / "profiles"))
+    results = processor.getResults()
+    assert (results["files"], results["inserted"], results["failed"]) == (6, 300, 0)
+    assert counter(processor, "profiler_errors") > 0
+
+
+def test_profiling_writes_profiles(tmp_path):
+    generateTree(str(tmp_path / "files"), files=2, rows=10, columns=3)
+    ingest(str(tmp_path / "files"), str(tmp_path / "profiles"))
+    assert os.listdir(str(tmp_path / "profiles"))
+
+
+def test_shared_profiler_covers_the_process(tmp_path):
+    profiler = ThreadProfiler(str(tmp_path), shared=True)
+    profiler.start()
+    assert profiler.profile() is None
+    sum(range(1000))
+    profiler.stop()
+    profiler.dump()
+    assert os.listdir(str(tmp_path)) == ["process.prof"]
@@ -0,0 +1,78 @@
+import datetime
+
+from healthandstatus.benchmark import FakeClient, FakeCollection
+from healthandstatus.mongodb import CustomMongodbDriver
+
+
+def createDriver():
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    return db
+
+
+def test_read_page_returns_whole_documents(monkeypatch):
+    db = createDriver()
+    db.create("c", [{"a": i, "date": datetime.datetime(2021, 3, 30, 0, i)} for i in range(3)])
+    find = FakeCollection.find
+
+    def findLikePymongo3(self, query=None, projection=None, limit=0):
+        # pymongo 3.11 sends an empty projection as {"_id": 1}
+        if projection is not None and not projection:
+            projection = {"_id": 1}
+        return find(self, query, projection, limit)
+
+    monkeypatch.setattr(FakeCollection, "find", findLikePymongo3)
+    documents, after = db.readPage("c", pageSize=10)
+    assert after is None
+    assert [d["a"] for d in documents] == [0, 1, 2]
+    assert all("_id" in d and "date" in d for d in documents)
+
+
+def test_read_page_keeps_the_boundary_fields():
+    db = createDriver()
+    db.create("c", [{"a": i, "b": -i, "date": datetime.datetime(2021, 3, 30, 0, i)} for i in range(3)])
+    documents, after = db.readPage("c", pageSize=2, projection={"a": True})
+    assert [sorted(d) for d in documents] == [["_id", "a", "date"]] * 2
+    documents, after = db.readPage("c", pageSize=2, after=after, projection={"_id": False, "b": False})
+    assert [sorted(d) for d in documents] == [["_id", "a", "date"]]
+    assert after is None
+
+
+def readAll(db, pageSize, **kwargs):
+    pages = []
+    after = None
+    while True:
+        documents, after = db.readPage("c", pageSize=pageSize, after=after, **kwargs)
+        pages.append(documents)
+        if after is None:
+            return pages
+
+
+def test_pages_walk_every_document_once_in_key_order():
+    db = createDriver()
+    # Several documents share each date, so _id breaks the ties
+    db.create("c", [{"_id": i, "a": i, "date": datetime.datetime(2021, 3, 30, 0, (i * 7) % 5)} for i in range(23)])
+    pages = readAll(db, 5)
+    assert [len(page) for page in pages] == [5, 5, 5, 5, 3]
+    documents = [d for page in pages for d in page]
+    assert sorted(d["a"] for d in documents) == list(range(23))
+    assert [(d["date"], d["_id"]) for d in documents] == sorted((d["date"], d["_id"]) for d in documents)
+
+
+def test_pages_respect_the_filter_and_a_full_last_page():
+    db = createDriver()
+    db.create("c", [{"_id": i, "system": "s{0}".format(i % 2), "date": datetime.datetime(2021, 3, 30, 0, i)}
+                    for i in range(12)])
+    pages = readAll(db, 3, data={"system": "s0"})
+    # Six matches fill two pages; the empty third confirms the end
+    assert [[d["_id"] for d in page] for page in pages] == [[0, 2, 4], [6, 8, 10], []]
+
+
+def test_rows_added_after_the_boundary_show_up_on_later_pages():
+    db = createDriver()
+    db.create("c", [{"_id": i, "date": datetime.datetime(2021, 3, 30, 0, i)} for i in range(4)])
+    documents, after = db.readPage("c", pageSize=2)
+    db.create("c", [{"_id": 10, "date": datetime.datetime(2021, 3, 30, 0, 0)},
+                    {"_id": 11, "date": datetime.datetime(2021, 3, 30, 0, 30)}])
+    documents, after = db.readPage("c", pageSize=10, after=after)
+    assert [d["_id"] for d in documents] == [2, 3, 11]
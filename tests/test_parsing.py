@@ -0,0 +1,88 @@
+import pytest
+
+from healthandstatus.ingest import IngestSettings
+from healthandstatus.parsing import parseFilename, readBlocks, readChunks
+
+NAME = "owner_collection_system_2021.03.30.00.00.00.dat"
+
+
+@pytest.fixture
+def messy(tmp_path):
+    ''' Blank lines, CRLF endings, uneven line lengths and no final newline '''
+    path = tmp_path / NAME
+    rows = []
+    for i in range(1000):
+        rows.append(b"" if i % 5 == 0 else "{0},{1},é{2}".format(i, "x" * (i % 37), i).encode('utf-8'))
+    path.write_bytes(b"\n#Tablename,a,b,c\r\n" + b"\r\n".join(rows) + b"\r\nlast,1,2")
+    return str(path)
+
+
+@pytest.mark.parametrize("chunkSize", [None, 1, 7, 100, 5000])
+@pytest.mark.parametrize("window", [1, 3, 64, 1 << 20])
+def test_block_reader_matches_text_reader(messy, chunkSize, window):
+    assert list(readBlocks(messy, ",", True, chunkSize, window)) == list(readChunks(messy, ",", True, chunkSize))
+
+
+@pytest.mark.parametrize("digest", [False, True])
+def test_readers_build_the_same_documents(messy, digest):
+    info = parseFilename(messy, "_")
+    documents = {}
+    for reader in ("text", "mmap"):
+        settings = IngestSettings()
+        settings.setIgnoreFirstHeader(True)
+        settings.setInferTypes(True)
+        settings.setReader(reader)
+        settings.setDigestId(digest)
+        chunks, parser = settings._openChunks(messy, ",", 100)
+        documents[reader] = []
+        for headers, lines in chunks:
+            schema = settings._resolveSchema("collection", headers, lines, ",")
+            documents[reader].extend(parser(info, headers, lines, ",", settings._idAlgorithm, schema))
+    assert len(documents["text"]) == 801
+    assert documents["mmap"] == documents["text"]
+
+
+@pytest.mark.parametrize("digest", [False, True])
+def test_process_workers_read_their_own_ranges(tmp_path, monkeypatch, digest):
+    from bson.raw_bson import RawBSONDocument
+    from healthandstatus import ingest
+    from healthandstatus.benchmark import FakeClient
+    from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+    from healthandstatus.splitter import generateTree
+
+    generateTree(str(tmp_path), files=4, rows=120, columns=4)
+
+    def run(engine):
+        db = CustomMongodbDriver(client=FakeClient())
+        db.setDatabase("HealthAndStatusTest")
+        processor = CustomMongodbFileProcessor(driver=db)
+        processor.setIgnoreFirstHeader(True)
+        processor.setProgress(False)
+        processor.setInferTypes(True)
+        processor.setDigestId(digest)
+        processor.setChunkSize(50)
+        processor.setParseBackend(engine, 2)
+        processor.start(src=str(tmp_path), splitchar="_", sep=",", traits=[".dat"])
+        assert processor.getResults()["inserted"] == 480
+        key = "_id" if digest else "hash"
+        documents = db.iterRead("collection0", {}, projection=None if digest else {"_id": False}, allFields=digest)
+        return db, sorted(documents, key=lambda d: d[key])
+
+    db, threaded = run("thread")
+
+    def readInParent(*args, **kwargs):
+        raise AssertionError("the parent read the file's lines")
+
+    monkeypatch.setattr(ingest, "readChunks", readInParent)
+    monkeypatch.setattr(ingest, "readBlocks", readInParent)
+    written = []
+    bulkCreate = CustomMongodbDriver.bulkCreate
+
+    def recordingBulkCreate(self, collection=None, data=None, rejected=None):
+        written.extend(data)
+        return bulkCreate(self, collection=collection, data=data, rejected=rejected)
+
+    monkeypatch.setattr(CustomMongodbDriver, "bulkCreate", recordingBulkCreate)
+    db, processed = run("process")
+    assert processed == threaded
+    assert all(isinstance(d, RawBSONDocument) for d in written)
@@ -0,0 +1,122 @@
+import os
+
+from pymongo import errors
+
+from healthandstatus.benchmark import FakeClient, FakeCollection
+from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor
+from healthandstatus.splitter import generateTree
+from healthandstatus.writer import BulkWriter
+
+FILES = 4
+ROWS = 50
+
+
+def ingest(db, root, overwrite=False):
+    processor = CustomMongodbFileProcessor(driver=db)
+    processor.setIgnoreFirstHeader(True)
+    processor.setProgress(False)
+    processor.setInferTypes(True)
+    processor.setChunkSize(20)
+    processor.setRollups(True, "hour")
+    processor.setOverwrite(overwrite)
+    processor.start(src=root, splitchar="_", sep=",", traits=[".dat"])
+    return processor.getResults()
+
+
+def createDriver():
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    db.setBulkWriter(BulkWriter(retries=1, backoff=0.001))
+    return db
+
+
+def rolledUp(db):
+    return sum(s["count"] for s in db.summarize("collection0", groupBy=()))
+
+
+def failAfterInsert(monkeypatch, error, once):
+    ''' Make every file's second chunk land its rows and then raise, on the
+    first attempt only if once '''
+    original = FakeCollection.bulk_write
+    failed = set()
+
+    def bulkWrite(self, requests, *args, **kwargs):
+        result = original(self, requests, *args, **kwargs)
+        first = requests[0]._doc
+        key = (first.get("system"), first.get("date"))
+        if first.get("metric0") == 20 and not (once and key in failed):
+            failed.add(key)
+            raise error("connection reset")
+        return result
+
+    monkeypatch.setattr(FakeCollection, "bulk_write", bulkWrite)
+
+
+def test_reingest_is_not_counted_twice(tmp_path):
+    generateTree(str(tmp_path), files=FILES, rows=ROWS, columns=3)
+    db = createDriver()
+    ingest(db, str(tmp_path))
+    ingest(db, str(tmp_path), overwrite=True)
+    assert rolledUp(db) == FILES * ROWS
+    stats = db.summarize("collection0", groupBy=())[0]["fields"]["metric0"]
+    assert (stats["min"], stats["max"], stats["count"]) == (0, ROWS - 1, FILES * ROWS)
+
+
+def test_rows_landed_before_a_retry_are_counted(tmp_path, monkeypatch):
+    generateTree(str(tmp_path), files=FILES, rows=ROWS, columns=3)
+    db = createDriver()
+    # The retry finds the first attempt's rows already there
+    failAfterInsert(monkeypatch, errors.AutoReconnect, once=True)
+    ingest(db, str(tmp_path))
+    assert rolledUp(db) == FILES * ROWS
+
+
+def test_rows_from_an_interrupted_run_are_counted_once(tmp_path, monkeypatch):
+    generateTree(str(tmp_path), files=FILES, rows=ROWS, columns=3)
+    db = createDriver()
+    # The connection drops once those chunks' rows have landed
+    failAfterInsert(monkeypatch, errors.ConnectionFailure, once=True)
+    results = ingest(db, str(tmp_path))
+    assert results["failed"] > 0
+    assert rolledUp(db) < FILES * ROWS
+
+    monkeypatch.undo()
+    ingest(db, str(tmp_path))
+    assert rolledUp(db) == FILES * ROWS
+    ingest(db, str(tmp_path), overwrite=True)
+    assert rolledUp(db) == FILES * ROWS
+
+
+def test_rows_of_a_rewritten_file_are_rolled_up(tmp_path):
+    generateTree(str(tmp_path), files=1, rows=ROWS, columns=3)
+    db = createDriver()
+    ingest(db, str(tmp_path))
+    assert rolledUp(db) == ROWS
+
+    # Same name, new values, later mtime
+    path = next(tmp_path.rglob("*.dat"))
+    stat = path.stat()
+    with open(str(path), 'w') as file:
+        file.write("#Tablename,metric0,metric1,metric2\n")
+        for r in range(ROWS):
+            file.write("{0},{1},{2}\n".format(r + 1000, r, r))
+    os.utime(str(path), (stat.st_atime, stat.st_mtime + 10))
+
+    results = ingest(db, str(tmp_path))
+    assert results["inserted"] == ROWS
+    assert len(db.read("collection0", {})) == 2 * ROWS
+    assert rolledUp(db) == 2 * ROWS
+
+
+def test_reingest_does_not_grow_the_ranges(tmp_path):
+    generateTree(str(tmp_path), files=1, rows=ROWS, columns=3)
+    db = createDriver()
+    ingest(db, str(tmp_path))
+    path = str(next(tmp_path.rglob("*.dat")))
+    ranges = list(db.readRollupRanges(path))
+    assert len(ranges) == 3
+
+    ingest(db, str(tmp_path), overwrite=True)
+    ingest(db, str(tmp_path), overwrite=True)
+    assert db.readRollupRanges(path) == ranges
+    assert rolledUp(db) == ROWS
@@ -0,0 +1,94 @@
+import datetime
+import hashlib
+
+import pytest
+
+from healthandstatus.benchmark import FakeClient
+from healthandstatus.mongodb import CustomMongodbDriver
+from healthandstatus.routing import CollectionRoutingPolicy, HashRangeRoutingPolicy
+
+
+def createDriver(routing, nodes=3):
+    clients = [FakeClient() for i in range(nodes)]
+    db = CustomMongodbDriver(nodes=clients, routing=routing)
+    db.setDatabase("HealthAndStatusTest")
+    return db, clients
+
+
+def stored(client, collection):
+    return list(client["HealthAndStatusTest"][collection].find())
+
+
+def test_hash_ranges_split_the_keyspace_in_order():
+    policy = HashRangeRoutingPolicy()
+    policy.bind(4)
+    assert policy.nodeFor("c", {"_id": b"\x00" * 16}) == 0
+    assert policy.nodeFor("c", {"_id": b"\x40" + b"\x00" * 15}) == 1
+    assert policy.nodeFor("c", {"_id": b"\xbf" + b"\xff" * 15}) == 2
+    assert policy.nodeFor("c", {"_id": b"\xff" * 16}) == 3
+    # The md5 hex column routes like its binary digest
+    digest = hashlib.md5(b"row").digest()
+    assert policy.nodeFor("c", {"hash": digest.hex()}) == policy.nodeFor("c", {"_id": digest})
+    assert policy.nodesFor("c") == [0, 1, 2, 3]
+
+
+def test_hash_ranges_leave_other_collections_on_the_first_node():
+    policy = HashRangeRoutingPolicy(collections=["c"])
+    policy.bind(4)
+    assert policy.nodesFor("other") == [0]
+    assert policy.nodeFor("other", {"_id": b"\xff" * 16}) == 0
+    assert policy.nodesFor("ingestedFiles") == [0]
+
+
+def test_collections_route_to_one_node():
+    policy = CollectionRoutingPolicy({"pinned": 2})
+    policy.bind(3)
+    assert policy.nodesFor("pinned") == [2]
+    assert policy.nodesFor("ingestedFiles") == [0]
+    spread = policy.nodesFor("spread")
+    assert len(spread) == 1 and spread == policy.nodesFor("spread")
+    with pytest.raises(Exception):
+        CollectionRoutingPolicy({"pinned": 3}).bind(3)
+
+
+def test_collection_routing_writes_to_its_node():
+    db, clients = createDriver(CollectionRoutingPolicy({"c": 1}))
+    db.create("c", [{"a": 1}, {"a": 2}])
+    assert [len(stored(client, "c")) for client in clients] == [0, 2, 0]
+    assert sorted(d["a"] for d in db.read("c", {})) == [1, 2]
+
+
+def test_bulk_create_splits_rows_by_hash_range():
+    db, clients = createDriver(HashRangeRoutingPolicy())
+    documents = [{"_id": bytes([i * 10]) + b"\x00" * 15, "a": i} for i in range(26)]
+    result = db.bulkCreate("c", documents)
+    assert result["inserted"] == 26
+    for node, client in enumerate(clients):
+        assert all(db.routing.nodeFor("c", d) == node for d in stored(client, "c"))
+        assert stored(client, "c")
+    # Rejections map back to indexes into the original batch
+    rejected = {}
+    result = db.bulkCreate("c", [documents[25], {"_id": b"\x01" * 16}, documents[0]], rejected)
+    assert (result["inserted"], result["duplicates"]) == (1, 2)
+    assert rejected == {0: "duplicate", 2: "duplicate"}
+
+
+def test_read_page_merges_the_nodes_in_order():
+    db, clients = createDriver(HashRangeRoutingPolicy())
+    documents = []
+    for i in range(40):
+        digest = hashlib.md5(str(i).encode('utf-8')).digest()
+        documents.append({"_id": digest, "a": i, "date": datetime.datetime(2021, 3, 30, 0, i % 7)})
+    db.bulkCreate("c", documents)
+    assert all(stored(client, "c") for client in clients)
+
+    pages = []
+    after = None
+    while True:
+        page, after = db.readPage("c", pageSize=6, after=after)
+        pages.append(page)
+        if after is None:
+            break
+    assert [len(page) for page in pages] == [6] * 6 + [4]
+    read = [(d["date"], d["_id"]) for page in pages for d in page]
+    assert read == sorted((d["date"], d["_id"]) for d in documents)
@@ -0,0 +1,27 @@
+from healthandstatus.parsing import parseLines
+from healthandstatus.schema import SchemaRegistry, convertColumn, inferType
+
+
+def test_int_column_widens_to_float():
+    assert convertColumn(int, ["1", "2", ""]) == [1, 2, None]
+    assert convertColumn(int, ["1", "2.5", "x"]) == [1, 2.5, "x"]
+
+
+def test_inferred_int_column_keeps_later_floats_numeric():
+    registry = SchemaRegistry(infer=True)
+    headers = ["cpu", "name"]
+    schema = registry.resolve("c", headers, ["1,a", "2,b"], ",")
+    assert schema == ("int", "str")
+
+    info = {"basename": "o_c_s_2021.03.30.00.00.00.dat", "owner": "o", "system": "s", "date": None}
+    docs = parseLines(info, headers, ["3,c", "2.5,d"], ",", schema=schema)
+    assert [d["cpu"] for d in docs] == [3, 2.5]
+    assert all(isinstance(d["cpu"], (int, float)) for d in docs)
+
+
+def test_infer_type():
+    assert inferType(["1", "2"]) == "int"
+    assert inferType(["1", "2.5"]) == "float"
+    assert inferType(["true", "False"]) == "bool"
+    assert inferType(["2021-03-30", ""]) == "datetime:%Y-%m-%d"
+    assert inferType(["a", "1"]) == "str"
@@ -0,0 +1,207 @@
+import json
+import os
+import signal
+import threading
+import time
+
+import pytest
+from pymongo import errors
+
+from healthandstatus import mongodb
+from healthandstatus.benchmark import FakeClient, FakeCollection
+from healthandstatus.mongodb import CustomMongodbDriver, CustomMongodbFileProcessor, _IngestTracker
+
+GOOD = "owner_collection_system_2021.03.30.00.00.00.dat"
+
+
+def writeFile(path, rows, start=0):
+    with open(path, 'a') as file:
+        if not start:
+            file.write("#Tablename,a,b\n")
+        for r in range(start, start + rows):
+            file.write("{0},{1}\n".format(r, r * 2))
+
+
+class Polls(object):
+    ''' Stage observer that lets a test wait for serve() to finish more polls '''
+
+    def __init__(self):
+        self.count = 0
+        self.__condition = threading.Condition()
+
+    def __call__(self, stage, seconds, rows=0):
+        if stage == "scan":
+            with self.__condition:
+                self.count += 1
+                self.__condition.notify_all()
+
+    def wait(self, polls=1, timeout=10):
+        with self.__condition:
+            target = self.count + polls
+            assert self.__condition.wait_for(lambda: self.count >= target, timeout)
+
+    def until(self, condition, timeout=10):
+        ''' Wait a poll at a time until condition() holds '''
+        deadline = time.time() + timeout
+        while not condition():
+            assert time.time() < deadline
+            self.wait(1, timeout)
+
+
+def startServing(root, db=None, manifestDigest=False):
+    if db is None:
+        db = CustomMongodbDriver(client=FakeClient())
+        db.setDatabase("HealthAndStatusTest")
+    processor = CustomMongodbFileProcessor(driver=db)
+    processor.setIgnoreFirstHeader(True)
+    processor.setManifestDigest(manifestDigest)
+    processor.polls = Polls()
+    processor.setStageObserver(processor.polls)
+    thread = threading.Thread(target=processor.serve,
+                              kwargs={"src": root, "traits": [".dat"], "interval": 0.05, "settle": 0.1,
+                                      "handleSignals": False})
+    thread.start()
+    return db, processor, thread
+
+
+def test_tracker_refuses_a_file_in_flight():
+    tracker = _IngestTracker()
+    tracker.reserve("f")
+    assert tracker.holds("f")
+    tracker.open("f", {"filename": "f"})
+    with pytest.raises(Exception):
+        tracker.open("f", {"filename": "f"})
+    tracker.add("f")
+    assert tracker.close("f") is None
+    assert tracker.commit("f") == {"filename": "f"}
+    assert not tracker.holds("f")
+
+
+def test_unreadable_file_waits_for_a_change(tmp_path, capsys):
+    bad = str(tmp_path / "bad_name.dat")
+    writeFile(bad, 3)
+    db, processor, thread = startServing(str(tmp_path))
+    out = []
+
+    def reported():
+        out.append(capsys.readouterr().out)
+        return "bad_name.dat:" in out[-1]
+
+    try:
+        for change in range(2):
+            if change:
+                writeFile(bad, 1, start=3)
+            processor.polls.until(reported)
+            # Well past the settle time, and still no second attempt
+            processor.polls.wait(10)
+            assert "".join(out).count("bad_name.dat:") == 1
+            del out[:]
+    finally:
+        processor.stop()
+        thread.join()
+
+
+def test_file_changed_in_flight_is_deferred(tmp_path, monkeypatch, capsys):
+    original = FakeCollection.bulk_write
+    entered = threading.Event()
+    release = threading.Event()
+
+    def heldWrite(self, *args, **kwargs):
+        entered.set()
+        release.wait(10)
+        return original(self, *args, **kwargs)
+
+    monkeypatch.setattr(FakeCollection, "bulk_write", heldWrite)
+    good = str(tmp_path / GOOD)
+    writeFile(good, 10)
+    db, processor, thread = startServing(str(tmp_path))
+    # Rows present each time the file is marked ingested
+    markedWith = []
+    final = threading.Event()
+    update = db.update
+
+    def recordingUpdate(collection=None, data=None, changes=None, upsert=False):
+        result = update(collection=collection, data=data, changes=changes, upsert=upsert)
+        if collection == "ingestedFiles":
+            markedWith.append((changes["size"], len(db.read("collection", {}))))
+            if changes["size"] == os.path.getsize(good):
+                final.set()
+        return result
+
+    db.update = recordingUpdate
+    try:
+        # The first copy is queued and waiting on its write
+        assert entered.wait(10)
+        writeFile(good, 10, start=10)
+        # Let the change settle and be seen while the first write is held
+        processor.polls.wait(10)
+        release.set()
+        assert final.wait(10)
+    finally:
+        processor.stop()
+        thread.join()
+
+    assert "already being ingested" not in capsys.readouterr().out
+    # The new copy is only marked once all of its rows are in
+    assert markedWith[-1] == (os.path.getsize(good), 20)
+    assert all(rows == 10 for size, rows in markedWith[:-1])
+
+
+def test_poll_errors_do_not_stop_serving(tmp_path, monkeypatch):
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+    iterRead = db.iterRead
+    failures = []
+
+    def flakyIterRead(collection=None, **kwargs):
+        if collection == "ingestedFiles" and not failures:
+            failures.append(collection)
+            raise errors.AutoReconnect("connection reset")
+        return iterRead(collection=collection, **kwargs)
+
+    db.iterRead = flakyIterRead
+    good = str(tmp_path / GOOD)
+    writeFile(good, 10)
+
+    marked = threading.Event()
+    update = db.update
+
+    def markingUpdate(collection=None, **kwargs):
+        result = update(collection=collection, **kwargs)
+        if collection == "ingestedFiles":
+            marked.set()
+        return result
+
+    db.update = markingUpdate
+    # A settled file that is gone by the time it is digested
+    monkeypatch.setattr(mongodb, "fileDigest", lambda filename: open(filename + ".missing"))
+
+    db, processor, thread = startServing(str(tmp_path), db, manifestDigest=True)
+    try:
+        processor.polls.wait(5)
+        assert thread.is_alive()
+        monkeypatch.undo()
+        assert marked.wait(10)
+    finally:
+        processor.stop()
+        thread.join()
+
+    assert failures
+    assert len(db.read("collection", {})) == 10
+    counters = {c["name"]: c["value"] for c in json.loads(processor.exportMetrics())["healthandstatus_ingest"]["counters"]}
+    assert counters["poll_errors"] >= 2
+
+
+def test_failed_startup_leaves_signal_handlers_alone(tmp_path, monkeypatch):
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("HealthAndStatusTest")
+
+    def unreachable(*args, **kwargs):
+        raise errors.ServerSelectionTimeoutError("no servers")
+
+    monkeypatch.setattr(db, "ensureIndex", unreachable)
+    before = signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)
+    processor = CustomMongodbFileProcessor(driver=db)
+    with pytest.raises(errors.ServerSelectionTimeoutError):
+        processor.serve(src=str(tmp_path), traits=[".dat"])
+    assert (signal.getsignal(signal.SIGINT), signal.getsignal(signal.SIGTERM)) == before
@@ -0,0 +1,108 @@
+import datetime
+import os
+
+import pytest
+
+from healthandstatus.parsing import parseFilename
+from healthandstatus.splitter import generateTree, splitFile, writeChunk
+
+START = datetime.datetime(2021, 3, 30, 0, 0, 0)
+
+
+def writeSource(path, rows, finalNewline=True):
+    with open(path, 'wb') as file:
+        file.write(b"#Tablename,a,b\n")
+        file.write(b"".join("{0},{1}\n".format(r, r * 2).encode('ascii') for r in range(rows)))
+        if not finalNewline:
+            file.write(b"last,0")
+    return path
+
+
+def readLines(path):
+    with open(path, 'rb') as file:
+        return file.read().split(b"\n")
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_chunks_hold_every_row_under_the_header(tmp_path, workers):
+    src = writeSource(str(tmp_path / "src.csv"), 23, finalNewline=False)
+    paths = splitFile(src, str(tmp_path / "out"), rowsPerFile=5, start=START, workers=workers)
+    assert len(paths) == 5
+    rows = []
+    for path in paths:
+        lines = readLines(path)
+        assert lines[0] == b"#Tablename,a,b"
+        # Every chunk, the last included, ends with a newline
+        assert lines[-1] == b""
+        rows.extend(lines[1:-1])
+    assert [len(readLines(path)) - 2 for path in paths] == [5, 5, 5, 5, 4]
+    assert rows == ["{0},{1}".format(r, r * 2).encode('ascii') for r in range(23)] + [b"last,0"]
+
+
+def test_chunk_names_are_unique_and_monotonic(tmp_path):
+    src = writeSource(str(tmp_path / "src.csv"), 10)
+    paths = splitFile(src, str(tmp_path / "out"), owner="own", collection="coll", system="sys", rowsPerFile=3,
+                      start=START, step=60)
+    infos = [parseFilename(path, "_") for path in paths]
+    assert [(i["owner"], i["collection"], i["system"]) for i in infos] == [("own", "coll", "sys")] * 4
+    assert [i["date"] for i in infos] == [START + datetime.timedelta(minutes=m) for m in range(4)]
+    assert sorted(os.listdir(str(tmp_path / "out"))) == [os.path.basename(p) for p in paths]
+
+
+def test_bad_names_and_sizes_are_refused(tmp_path):
+    src = writeSource(str(tmp_path / "src.csv"), 3)
+    with pytest.raises(Exception):
+        splitFile(src, str(tmp_path / "out"), owner="a_b")
+    with pytest.raises(Exception):
+        splitFile(src, str(tmp_path / "out"), rowsPerFile=0)
+    with pytest.raises(Exception):
+        splitFile(src, str(tmp_path / "out"), step=0.5)
+
+
+def test_chunks_never_overwrite(tmp_path):
+    path = writeChunk(str(tmp_path / "chunk.dat"), b"#h\n", [b"1\n"])
+    with pytest.raises(FileExistsError):
+        writeChunk(path, b"#h\n", [b"2\n"])
+    assert readLines(path) == [b"#h", b"1", b""]
+
+
+def test_generated_tree_does_not_depend_on_workers(tmp_path):
+    trees = []
+    for workers in (1, 2):
+        root = str(tmp_path / "tree{0}".format(workers))
+        assert generateTree(root, files=6, rows=10, columns=3, workers=workers) == 60
+        tree = {}
+        for directory, dirs, files in os.walk(root):
+            for name in files:
+                with open(os.path.join(directory, name), 'rb') as file:
+                    tree[os.path.join(os.path.relpath(directory, root), name)] = file.read()
+        trees.append(tree)
+    assert len(trees[0]) == 6
+    assert trees[0] == trees[1]
+
+
+def test_second_split_starts_after_the_newest_chunk(tmp_path):
+    src = writeSource(str(tmp_path / "src.csv"), 10)
+    dest = str(tmp_path / "out")
+    future = datetime.datetime.utcnow().replace(microsecond=0) + datetime.timedelta(hours=1)
+    first = splitFile(src, dest, rowsPerFile=3, start=future)
+    second = splitFile(src, dest, rowsPerFile=3)
+    again = splitFile(src, dest, rowsPerFile=3)
+    dates = [parseFilename(path, "_")["date"] for path in first + second + again]
+    assert dates == sorted(set(dates))
+    assert dates[len(first)] == future + datetime.timedelta(seconds=len(first))
+    # Other owners, collections and systems don't hold the start back
+    other = splitFile(src, dest, system="other", rowsPerFile=3)
+    assert parseFilename(other[0], "_")["date"] < future
+
+
+def test_explicit_start_clash_writes_nothing(tmp_path):
+    src = writeSource(str(tmp_path / "src.csv"), 10)
+    dest = str(tmp_path / "out")
+    splitFile(src, dest, rowsPerFile=3, start=START)
+    before = sorted(os.listdir(dest))
+    with pytest.raises(Exception):
+        splitFile(src, dest, rowsPerFile=3, start=START + datetime.timedelta(seconds=2))
+    assert sorted(os.listdir(dest)) == before
+    later = splitFile(src, dest, rowsPerFile=3, start=START + datetime.timedelta(seconds=4))
+    assert len(os.listdir(dest)) == len(before) + len(later)
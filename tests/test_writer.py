@@ -0,0 +1,79 @@
+from pymongo import errors
+import pytest
+
+from healthandstatus.benchmark import FakeClient, FakeCollection
+from healthandstatus.mongodb import CustomMongodbDriver
+from healthandstatus.writer import AdaptiveBatcher, BulkWriter
+
+
+class WriteConcernTimeout(object):
+    ''' Accepts every row on the primary but never meets the write concern '''
+    name = "c"
+
+    def with_options(self, **kwargs):
+        return self
+
+    def bulk_write(self, requests, ordered=True, bypass_document_validation=False):
+        raise errors.BulkWriteError({"nInserted": len(requests), "writeErrors": [],
+                                     "writeConcernErrors": [{"code": 64, "errmsg": "waiting for replication timed out"}]})
+
+
+class LostAfterFirstBatch(object):
+    ''' Writes the first batch, then loses the connection for good '''
+    name = "c"
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.calls = 0
+
+    def with_options(self, **kwargs):
+        return self
+
+    def bulk_write(self, requests, ordered=True, bypass_document_validation=False):
+        self.calls += 1
+        if self.calls > 1:
+            raise errors.AutoReconnect("connection closed")
+        return self.collection.bulk_write(requests, ordered=ordered)
+
+
+def test_duplicates_are_not_failures():
+    collection = FakeClient()["db"]["c"]
+    writer = BulkWriter()
+    writer.write(collection, [{"_id": 1}])
+    rejected = {}
+    result = writer.write(collection, [{"_id": 1}, {"_id": 2}], rejected)
+    assert (result["inserted"], result["duplicates"], result["failed"]) == (1, 1, 0)
+    assert rejected == {0: "duplicate"}
+
+
+def test_write_concern_errors_fail_the_batch():
+    rejected = {}
+    result = BulkWriter().write(WriteConcernTimeout(), [{"_id": 1}, {"_id": 2}], rejected)
+    assert result["inserted"] == 0
+    assert result["failed"] == 2
+    assert rejected == {0: "failed", 1: "failed"}
+
+
+def test_lost_connection_keeps_partial_counts():
+    collection = LostAfterFirstBatch(FakeClient()["db"]["c"])
+    writer = BulkWriter(batcher=AdaptiveBatcher(initialDocs=2, minDocs=2), retries=1, backoff=0)
+    rejected = {}
+    result = writer.write(collection, [{"_id": i} for i in range(5)], rejected)
+    assert (result["inserted"], result["duplicates"], result["failed"]) == (2, 0, 3)
+    assert isinstance(result["error"], errors.AutoReconnect)
+    assert rejected == {2: "failed", 3: "failed", 4: "failed"}
+    assert sorted(d["_id"] for d in collection.collection.find()) == [0, 1]
+
+
+def test_create_exits_when_the_connection_is_lost(monkeypatch):
+    db = CustomMongodbDriver(client=FakeClient())
+    db.setDatabase("db")
+    db.writer.retries = 0
+
+    def lost(self, requests, ordered=True, bypass_document_validation=False):
+        raise errors.AutoReconnect("connection closed")
+
+    monkeypatch.setattr(FakeCollection, "bulk_write", lost)
+    with pytest.raises(SystemExit) as exited:
+        db.create("c", [{"_id": 1}])
+    assert exited.value.code == 1